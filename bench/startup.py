@@ -0,0 +1,118 @@
+"""
+Startup time benchmark.
+
+Measures, for each entry point, how long its imports take and how long the
+process takes to be ready from launch: for the worker, until it logs that it's
+ready to tick; for the server, until it answers HTTP. Each is run against a
+throwaway file store with placeholder Spotify credentials, so nothing here needs
+network access. Exits non-zero if anything goes over budget.
+
+Usage:
+    $ python bench/startup.py --runs 3 --import-budget 1.5 --ready-budget 4
+"""
+import argparse
+import os
+import queue
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+Root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def environment() -> dict:
+    env = dict(os.environ)
+    env.update(STORE_NAME="file", FILESTORE_PATH=tempfile.mkdtemp(prefix="startup-bench-"),
+               SPOTIFY_CLIENT_ID="bench", SPOTIFY_CLIENT_SECRET="bench",
+               SPOTIFY_REDIRECT_URI="http://localhost/auth", LOG_LEVEL="INFO")
+    return env
+
+
+def import_time(module: str, env: dict) -> float:
+    """Seconds to import an entry point module in a fresh interpreter."""
+    code = ("import time; start = time.perf_counter(); import %s; "
+            "print(time.perf_counter() - start)" % module)
+    out = subprocess.run([sys.executable, "-c", code], cwd=Root, env=env,
+                         check=True, capture_output=True, text=True)
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def worker_ready(env: dict, timeout: float) -> float:
+    """Seconds from launching the worker until it logs that it's ready."""
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, "worker.py"], cwd=Root, env=env,
+                            stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, text=True)
+    lines = queue.Queue()
+
+    def read():
+        for line in proc.stderr:
+            lines.put(line)
+        lines.put("")
+    threading.Thread(target=read, daemon=True).start()
+    try:
+        while True:
+            remaining = timeout - (time.perf_counter() - start)
+            try:
+                line = lines.get(timeout=max(remaining, 0))
+            except queue.Empty:
+                return float("inf")
+            if not line:
+                # The worker exited before it was ready.
+                return float("inf")
+            if "Worker ready" in line:
+                return time.perf_counter() - start
+    finally:
+        proc.kill()
+        proc.wait()
+
+
+def server_ready(env: dict, timeout: float) -> float:
+    """Seconds from launching the server until it answers a request."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, "serve.py", "--port", str(port)], cwd=Root, env=env,
+                            stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - start < timeout:
+            if proc.poll() is not None:
+                break
+            try:
+                urllib.request.urlopen("http://127.0.0.1:%d/budget" % port, timeout=0.5)
+                return time.perf_counter() - start
+            except OSError:
+                time.sleep(0.02)
+        return float("inf")
+    finally:
+        proc.kill()
+        proc.wait()
+
+
+def main(args) -> int:
+    env = environment()
+    results = {}
+    for name, module, ready in (("worker", "worker", worker_ready), ("serve", "serve", server_ready)):
+        imports = min(import_time(module, env) for _ in range(args.runs))
+        startup = min(ready(env, args.ready_budget * 2) for _ in range(args.runs))
+        results[name] = (imports, startup)
+    failed = False
+    print(f"{'':8}{'import s':>10}{'ready s':>10}")
+    for name, (imports, startup) in results.items():
+        over = imports > args.import_budget or startup > args.ready_budget
+        failed = failed or over
+        print(f"{name:8}{imports:10.3f}{startup:10.3f}" + ("  OVER BUDGET" if over else ""))
+    print(f"budget: import {args.import_budget}s, ready {args.ready_budget}s")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=3, help="Best of this many runs")
+    parser.add_argument("--import-budget", type=float, default=1.5, help="Max seconds to import")
+    parser.add_argument("--ready-budget", type=float, default=4.0, help="Max seconds from launch to ready")
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,78 @@
+"""
+Store backend benchmark.
+
+Times the operations the worker and web server lean on, against each store
+backend, with a room of fake followers. Redis is only included if REDIS_HOST
+is set.
+
+Usage:
+    $ python bench/stores.py --users 500 --rounds 20
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.store import get_store  # noqa: E402
+
+
+async def timed(rounds: int, fn) -> float:
+    """Mean milliseconds per call of fn over the given rounds."""
+    start = time.perf_counter()
+    for _ in range(rounds):
+        await fn()
+    return (time.perf_counter() - start) / rounds * 1000
+
+
+async def bench(name: str, users: int, rounds: int) -> dict:
+    store = await get_store(name)
+    user_ids = [f"bench-user-{i}" for i in range(users)]
+    token = "A" * 131
+
+    async def write_tokens():
+        await asyncio.gather(*[store.write_token(u, token) for u in user_ids])
+
+    async def get_each():
+        await asyncio.gather(*[store.get_token(u) for u in user_ids])
+
+    async def get_batch():
+        await store.get_tokens(user_ids)
+
+    async def song():
+        await store.update_song({"playing": 1})
+        await store.get_song()
+
+    results = {
+        "write_tokens": await timed(1, write_tokens),
+        "list_tokens": await timed(rounds, store.list_tokens),
+        "get_token x N": await timed(rounds, get_each),
+        "get_tokens": await timed(rounds, get_batch),
+        "song rw": await timed(rounds, song),
+    }
+    await asyncio.gather(*[store.delete_token(u) for u in user_ids])
+    return results
+
+
+async def main(args):
+    backends = ["file", "sqlite"] + (["redis"] if os.environ.get("REDIS_HOST") else [])
+    os.environ.setdefault("FILESTORE_PATH", tempfile.mkdtemp(prefix="store-bench-"))
+    # Config validation wants these, though nothing here talks to Spotify.
+    for key in ("STORE_NAME", "SPOTIFY_CLIENT_ID", "SPOTIFY_CLIENT_SECRET", "SPOTIFY_REDIRECT_URI"):
+        os.environ.setdefault(key, "bench")
+    results = {name: await bench(name, args.users, args.rounds) for name in backends}
+    ops = list(next(iter(results.values())))
+    print(f"{args.users} users, ms per operation")
+    print(f"{'':16}" + "".join(f"{name:>10}" for name in backends))
+    for op in ops:
+        print(f"{op:16}" + "".join(f"{results[name][op]:10.2f}" for name in backends))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--rounds", type=int, default=10)
+    asyncio.run(main(parser.parse_args()))
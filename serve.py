@@ -3,23 +3,36 @@ Main API server
 """
 import argparse
 import asyncio
+import functools
+import json
 import logging
+import math
 import random
+import secrets
+import signal
 import string
+import time
 
-from typing import Optional, Dict, Union
+from typing import Callable, Optional, Dict, List, Union
 
 import tekore as tk
 
-from quart import Quart, request, redirect, url_for, session, render_template
+from quart import Quart, request, redirect, url_for, session, render_template, jsonify
 
 # from utils import store
-from utils import config
-from utils.store import get_store
+from utils import config, logs
+from utils.assets import Asset, Assets, Immutable, Revalidate
+from utils.budget import Budget
+from utils.events import EventId, read_events
+from utils.nowplaying import wait_song
+from utils.store import new_store
 from utils.spotify import Spotify
+from utils.tracks import TrackCache
 
 app = Quart(__name__)
 app.secret_key = str(random.choices(string.printable, k=128))
+# Keep the session cookie off cross-site POSTs, so other sites can't drive the admin API.
+app.config["SESSION_COOKIE_SAMESITE"] = "Lax"
 
 
 def set_session_token(token: tk.Token) -> None:
@@ -43,35 +56,101 @@ def get_session_token() -> Optional[str]:
     return session.get("r_t")
 
 
-def current_track_info(now_playing: Optional[tk.model.CurrentlyPlaying]) -> Dict[str, Union[str, bool]]:
-    """Format current track info from Spotify
+async def remember_session(user_id: str) -> None:
+    """Record which user the current session belongs to, for SESSION_TTL seconds.
 
-    This function standardizes the output from spotify's currently_playing api,
-    accounting for its unaccountable tendency to return "None."
+    Gives the session an ID if it doesn't have one yet. Writing it again
+    restarts the TTL, so sessions in use never expire.
 
     Parameters
     ----------
-    now_playing: tk.model.CurrentlyPlaying or None
-        The object returned from the spotify client
+    user_id: str
+        The session's user
+    """
+    if "sid" not in session:
+        session["sid"] = secrets.token_urlsafe(24)
+    await app.store.write_session(session["sid"], user_id, config.settings.SESSION_TTL)
+
+
+async def get_session_user() -> Optional[str]:
+    """Look up the current session's user from the store, without calling Spotify.
+
+    Returns
+    -------
+    str or None: The user's ID, or None if the session isn't known.
+    """
+    session_id = session.get("sid")
+    return await app.store.get_session(session_id) if session_id else None
+
+
+async def is_main_session() -> bool:
+    """Whether the current session logged in as the main user, per the store."""
+    session_id = session.get("main_sid")
+    return bool(session_id) and await app.store.get_session(session_id) == "main"
+
+
+def main_only(view):
+    """Refuse a view to everyone but the main user's sessions."""
+    @functools.wraps(view)
+    async def wrapper(*args, **kwargs):
+        if not await is_main_session():
+            return "Main user only", 403
+        return await view(*args, **kwargs)
+    return wrapper
+
+
+def forget_session() -> None:
+    """Drop the current session's ID and token from its cookie."""
+    session.pop("sid", None)
+    session.pop("r_t", None)
+
+
+def query_number(name: str, convert: Callable, default: Union[int, float], low: Union[int, float],
+                 high: Union[int, float]) -> Optional[Union[int, float]]:
+    """Read a numeric query argument, capped at `high`.
+
+    Returns
+    -------
+    int or float or None: The value, or None if it isn't a finite number of at least `low`.
+    """
+    try:
+        value = convert(request.args.get(name, default))
+    except (TypeError, ValueError):
+        return None
+    if not math.isfinite(value) or value < low:
+        return None
+    return min(value, high)
+
+
+def current_track_info(song: Dict[str, Union[str, int]], track: Optional[Dict[str, Union[str, int]]]) -> Dict[str, Union[str, bool]]:
+    """Format current track info for display
+
+    This function standardizes the now-playing record the worker writes to the
+    store, and the cached track metadata it points at, either of which can be
+    empty if nothing is playing.
+
+    Parameters
+    ----------
+    song: {str: str or int}
+        The now-playing record from the store
+    track: {str: str or int} or None
+        Flattened track info from the track cache, if anything is playing.
 
     Returns
     -------
     {str: str or bool}: Formatted dictionary containing the current track, artist,
         device, and album art, as well as whether the player is playing.
     """
-    if now_playing is None:
+    if not track:
         title = "Not Playing"
         artist = ""
-        playing = False
-        device = "None"
         art = ""
     else:
-        song = now_playing.item
-        title = song.name
-        artist = ", ".join([artist.name for artist in song.artists])
-        playing = now_playing.is_playing
-        device = now_playing.device.name
-        art = song.album.images[2].url
+        title = track["name"]
+        artist = track["artists"]
+        art = track["art"]
+    playing = bool(int(song.get("playing", 0)))
+    device = song.get("device") or "None"
     return {"title": title, "artist": artist, "playing": playing, "device": device, "art": art}
 
 
@@ -80,19 +159,29 @@ async def main():
     """Display any available information about the main user."""
     try:
         main_token = await app.store.get_token("main")
-        logging.info(main_token)
     except:
         return f"No token for main user. Please <a href='{url_for('main_register')}'>log in to register as main user</a>."
     try:
         token = await app.spotify.refresh_token(main_token)
         client = await app.spotify.get_client(token)
+    except Budget.Exhausted:
+        raise
     except:
-        "Bad token for main user. Please reset and register main user"
+        return "Bad token for main user. Please reset and register main user"
     else:
-        current_user, now_playing, followers = await asyncio.gather(
-            client.current_user(), client.playback(), app.store.list_tokens())
-        track_info = current_track_info(now_playing)
-        return await render_template("main.html", track_info=track_info, name=current_user.display_name, followers=followers)
+        profile, song = await asyncio.gather(
+            app.spotify.get_profile(client, main_token), app.store.get_song())
+        track = None
+        if song.get("track_id"):
+            try:
+                track = await app.tracks.fetch(song["track_id"], client)
+            except:
+                logging.exception("Couldn't look up track %s", song["track_id"])
+        track_info = current_track_info(song, track)
+        if await is_main_session():
+            # Restart the TTL, so the main user stays logged in while they use the page.
+            await app.store.write_session(session["main_sid"], "main", config.settings.SESSION_TTL)
+        return await render_template("main.html", track_info=track_info, name=profile["display_name"])
 
 
 @app.route("/main/register")
@@ -111,59 +200,176 @@ async def main_register():
 async def main_reset():
     """Deregister a main user."""
     logging.info("Deregistering main user")
-    await app.store.delete_token("main")
+    await asyncio.gather(app.store.delete_token("main"), app.store.delete_sessions("main"))
     return "Reset main"
 
 
-@app.route("/logout")
-async def logout():
-    """Delete the tokens in the store matching the session token, if one is present.
+@app.route("/api/followers", methods=["GET"])
+@main_only
+async def api_followers():
+    """List followers one page at a time, with their presence and last sync.
+
+    Query arguments:
+        cursor: The "next" value from the previous page. Omit for the first page.
+        limit: Page size (default 50, max 200).
+
+    Returns JSON: {"followers": [{"id", "present", "ok", "latency_ms", "last_sync"}],
+    "next": cursor for the next page, or null on the last page}. ok, latency_ms
+    and last_sync are null for followers the worker hasn't synced yet.
+    """
+    limit = query_number("limit", int, 50, 1, 200)
+    if limit is None:
+        return "Bad limit", 400
+    cursor, user_ids = await app.store.scan_tokens(request.args.get("cursor", ""), limit)
+    user_ids = [user_id for user_id in user_ids if user_id != "main"]
+    statuses, present = await asyncio.gather(
+        app.store.get_statuses(user_ids), app.store.list_present())
+    present = set(present)
+    followers = []
+    for user_id in user_ids:
+        status = statuses.get(user_id, {})
+        followers.append({"id": user_id, "present": user_id in present,
+                          "ok": bool(status["ok"]) if status else None,
+                          "latency_ms": status.get("ms"), "last_sync": status.get("ts")})
+    return jsonify({"followers": followers, "next": cursor})
+
+
+async def get_json_body() -> Optional[dict]:
+    """Read the request's body as a JSON object.
+
+    The body must be sent as application/json, which a cross-site form can't do.
 
-    The logout itself is scheduled as a separate task on the event loop because
-    quart interrupts the function immediately if the client disconnects.
+    Returns
+    -------
+    dict or None: The body, or None if it isn't a JSON object sent as JSON.
     """
-    async def logout_process(token_str: str):
-        """Remove a given token from the store.
+    if not request.is_json:
+        return None
+    body = await request.get_json(silent=True)
+    return body if isinstance(body, dict) else None
 
-        Note we need to get a new client for the token first, since tokens are
-        stored by user_id.
 
-        Parameters
-        ----------
-        token_str: The token string to remove from the store.
-        """
-        logging.info("Starting logout")
-        if not token_str:
-            return
+async def get_user_ids() -> Optional[List[str]]:
+    """Read a list of follower IDs from the request's JSON body: {"ids": [...]}.
+
+    Returns
+    -------
+    [str] or None: The IDs, less "main", or None if the body isn't shaped like that.
+    """
+    body = await get_json_body()
+    if body is None:
+        return None
+    user_ids = body.get("ids", [])
+    if not isinstance(user_ids, list) or not all(isinstance(user_id, str) for user_id in user_ids):
+        return None
+    return [user_id for user_id in user_ids if user_id != "main"]
+
+
+@app.route("/api/followers/kick", methods=["POST"])
+@main_only
+async def api_kick():
+    """Remove the given followers' tokens and sessions, so they're dropped from syncs.
+
+    They're also banned for KICK_BAN_TTL seconds, so their players can't just log
+    straight back in.
+    """
+    user_ids = await get_user_ids()
+    if user_ids is None:
+        return "Expected {\"ids\": [...]}", 400
+    logging.info("Kicking %d followers", len(user_ids))
+    ttl = config.settings.KICK_BAN_TTL
+    # Ban first, so a player refreshing its token mid-kick can't write it back.
+    await asyncio.gather(*[app.store.write_ban(user_id, ttl) for user_id in user_ids])
+    await asyncio.gather(*[app.store.delete_token(user_id) for user_id in user_ids],
+                         *[app.store.delete_presence(user_id) for user_id in user_ids],
+                         *[app.store.delete_quarantine(user_id) for user_id in user_ids],
+                         *[app.store.delete_sessions(user_id) for user_id in user_ids])
+    return jsonify({"kicked": user_ids})
+
+
+@app.route("/api/followers/resync", methods=["POST"])
+@main_only
+async def api_resync():
+    """Ask the worker to restart the given followers at the leader's position."""
+    user_ids = await get_user_ids()
+    if user_ids is None:
+        return "Expected {\"ids\": [...]}", 400
+    if user_ids:
+        await app.store.push_commands([{"kind": "resync", "users": user_ids}])
+    return jsonify({"resync": user_ids})
+
+
+@app.route("/api/room/<kind>", methods=["POST"])
+@main_only
+async def api_room(kind: str):
+    """Queue a room-wide command for the worker.
+
+    kind is one of skip, pause, resume, volume or resync. Volume takes a JSON
+    body of {"level": 0-100}; resync here means everyone. The worker merges
+    whatever has queued up and runs it on its next tick, so the web server never
+    calls Spotify for each follower. Every kind needs a JSON object body, even if
+    it's just {}.
+    """
+    body = await get_json_body()
+    if body is None:
+        return "Expected a JSON object", 400
+    if kind in ("skip", "pause", "resume"):
+        command = {"kind": kind}
+    elif kind == "volume":
         try:
-            token = await app.spotify.refresh_token(token_str)
-            user_id = await app.spotify.get_user_id(token)
-            logging.info("Deregistering %s", user_id)
-            await app.store.delete_token(user_id)
-        except:
-            logging.exception("Failed to deregister user")
-    asyncio.create_task(logout_process(get_session_token()))
+            command = {"kind": kind, "level": max(0, min(100, int(body.get("level"))))}
+        except (TypeError, ValueError, OverflowError):
+            # OverflowError for infinities, which JSON parses 1e400 to.
+            return "Bad volume", 400
+    elif kind == "resync":
+        command = {"kind": kind, "all": True}
+    else:
+        return "Unknown command", 404
+    await app.store.push_commands([command])
+    return jsonify(command)
+
+
+@app.route("/logout")
+async def logout():
+    """Delete the token and presence of the session's user, and forget the session.
+
+    The session's user is looked up in the store, so this never calls Spotify.
+    """
+    session_id = session.get("sid")
+    forget_session()
+    user_id = await app.store.pop_session(session_id) if session_id else None
+    if user_id:
+        logging.info("Deregistering %s", user_id)
+        # Quarantined tokens too, or the sweeper could bring them back.
+        await asyncio.gather(app.store.delete_token(user_id),
+                             app.store.delete_presence(user_id),
+                             app.store.delete_quarantine(user_id))
     return "Logged out."
 
 
 @app.route("/auth", methods=["GET"])
 async def auth():
     """Spotify Auth callback. Expects a 'code' argument on the url."""
-    logging.info("[AUTH FLOW] Got code: %s", request.args["code"])
+    logging.info("[AUTH FLOW] Got code")
     token = await app.spotify.token_from_code(request.args["code"])
-    logging.info("[AUTH FLOW] Got token: %s", token.access_token)
     if request.args["state"] == "main":
         logging.info("[AUTH FLOW] Auth is for main user.")
-        await app.store.write_token("main", token.refresh_token)
+        # A separate ID from the follower session, so the main user can also follow in this browser.
+        session["main_sid"] = secrets.token_urlsafe(24)
+        await asyncio.gather(
+            app.store.write_token("main", token.refresh_token),
+            app.store.write_session(session["main_sid"], "main", config.settings.SESSION_TTL))
         logging.info("[AUTH FLOW] Redirect to /main")
         return redirect("/main")
     else:
         logging.info("[AUTH FLOW] Auth is for a follower.")
-        logging.info("[AUTH FLOW] refresh token: %s", token.refresh_token)
-        set_session_token(token)
-        logging.info("[AUTH FLOW] Session cookie: %s", get_session_token())
         user_id = await app.spotify.get_user_id(token)
-        await app.store.write_token(user_id, token.refresh_token)
+        if await app.store.is_banned(user_id):
+            logging.info("[AUTH FLOW] %s is banned", user_id)
+            return "Banned", 403
+        set_session_token(token)
+        await asyncio.gather(app.store.write_token(user_id, token.refresh_token),
+                             remember_session(user_id))
         logging.info("[AUTH FLOW] Redirect to /.")
         return redirect(f"/")
 
@@ -172,54 +378,195 @@ async def auth():
 async def token():
     """Return an access token generated from the refresh token in the session cookie.
 
-    This endpoint is used by the web player to obtain an updated token.
+    This endpoint is used by the web player to obtain an updated token. The
+    session's user comes from the store; Spotify is only asked who it is for
+    sessions the store doesn't know.
     """
-    logging.info("[AUTH FLOW: Token] Checking Token")
+    logging.debug("[AUTH FLOW: Token] Checking Token")
     session_token = get_session_token()
     if not session_token:
         logging.info("[AUTH FLOW: Token] Missing cookie")
         return "Missing cookie", 400
     try:
-        token = await app.spotify.refresh_token(session_token)
-        user_id = await app.spotify.get_user_id(token)
+        token, user_id = await asyncio.gather(
+            app.spotify.refresh_token(session_token), get_session_user())
+        if user_id is None:
+            user_id = await app.spotify.get_user_id(token)
+    except Budget.Exhausted:
+        raise
     except:
         logging.exception("[AUTH FLOW: Token] Couldn't refresh token")
         return "Bad Token", 400
-    logging.info("[AUTH FLOW: Token] Got token: %s", token.refresh_token)
-    await app.store.write_token(user_id, token.refresh_token)
+    if await app.store.is_banned(user_id):
+        logging.info("[AUTH FLOW: Token] %s is banned", user_id)
+        forget_session()
+        return "Banned", 403
+    logging.debug("[AUTH FLOW: Token] Refreshed token for %s", user_id)
+    await asyncio.gather(app.store.write_token(user_id, token.refresh_token),
+                         remember_session(user_id))
     set_session_token(token)
     return token.access_token
 
 
+@app.route("/heartbeat", methods=["POST"])
+async def heartbeat():
+    """Record whether the player in this session is still around.
+
+    The web player posts {"state": "ready" or "not_ready", "device_id": ...}
+    when its device comes or goes, and "ready" periodically while it's open.
+    Players that stop checking in drop out of the worker's syncs after
+    PRESENCE_TTL seconds.
+    """
+    session_token = get_session_token()
+    if not session_token:
+        return "Missing cookie", 400
+    try:
+        beat = json.loads(await request.get_data() or "{}")
+    except ValueError:
+        return "Bad heartbeat", 400
+    if not isinstance(beat, dict) or not isinstance(beat.get("device_id", ""), (str, type(None))):
+        return "Bad heartbeat", 400
+    user_id, token = await get_session_user(), None
+    if user_id is None:
+        try:
+            token = await app.spotify.refresh_token(session_token)
+            user_id = await app.spotify.get_user_id(token)
+        except Budget.Exhausted:
+            raise
+        except:
+            logging.exception("[HEARTBEAT] Couldn't identify user")
+            return "Bad Token", 400
+    if await app.store.is_banned(user_id):
+        forget_session()
+        return "Banned", 403
+    if token is not None:
+        set_session_token(token)
+        await remember_session(user_id)
+    if beat.get("state") == "not_ready":
+        await app.store.delete_presence(user_id)
+        return "", 204
+    writes = [app.store.write_presence(user_id, config.settings.PRESENCE_TTL)]
+    if beat.get("device_id"):
+        writes.append(app.store.write_device(user_id, beat["device_id"]))
+    await asyncio.gather(*writes)
+    return "", 204
+
+
+@app.route("/budget", methods=["GET"])
+async def budget():
+    """Report how much of the shared Spotify API budget is in use."""
+    return jsonify(await app.spotify.budget.usage())
+
+
+@app.route("/events", methods=["GET"])
+@main_only
+async def events():
+    """Return recent sync events from the worker as JSON.
+
+    Query arguments:
+        after: Event ID to read from. Without it, the latest events are returned.
+        count: Max events to return (default 100, max 1000).
+        wait: Seconds to wait for a new event if there's nothing after `after` yet (max 30).
+
+    Clients can tail the log by passing the last ID they saw back as `after`.
+    Events name followers, so like the admin API this is for the main user only.
+    """
+    count = query_number("count", int, 100, 1, 1000)
+    if count is None:
+        return "Bad count", 400
+    wait = query_number("wait", float, 0, 0, 30)
+    if wait is None:
+        return "Bad wait", 400
+    after = request.args.get("after")
+    if after is not None and not EventId.fullmatch(after):
+        return "Bad after", 400
+    entries = await read_events(app.store, after, count, wait)
+    return jsonify([dict(event, id=event_id) for event_id, event in entries])
+
+
+@app.route("/song", methods=["GET"])
+async def song():
+    """Return what the leader is playing as JSON.
+
+    Query arguments:
+        version: Version the client already has. Defaults to 0.
+        wait: Seconds to wait for a newer version than `version` (max 30).
+
+    The response includes the record's "version". Pass it back to long-poll for
+    the next change. Track details are only included if they're already cached.
+    """
+    version = query_number("version", int, 0, 0, math.inf)
+    if version is None:
+        return "Bad version", 400
+    wait = query_number("wait", float, 0, 0, 30)
+    if wait is None:
+        return "Bad wait", 400
+    record = await wait_song(app.store, version, wait)
+    track = await app.tracks.get(record["track_id"]) if record.get("track_id") else None
+    return jsonify(dict(current_track_info(record, track), version=int(record.get("version", 0))))
+
+
+@app.errorhandler(Budget.Exhausted)
+async def budget_exhausted(err):
+    """Shed web requests while the worker needs the API budget."""
+    return "Busy, try again shortly", 503, {"Retry-After": str(app.spotify.budget.window)}
+
+
 @app.route('/', methods=["POST", "GET", "PUT"])
 async def index():
     """Main index page. Redirects into the auth flow if no session token is found"""
-    logging.info("[AUTH FLOW: index] Hit Index")
+    logging.debug("[AUTH FLOW: index] Hit Index")
     session_token = get_session_token()
     if not session_token:
         logging.info(
             "[AUTH FLOW: index] No Session cookie. Redirecting to auth")
         return redirect(app.spotify.auth_url("follow"))
     else:
-        logging.info("[AUTH FLOW: index] Session cookie: %s", session_token)
-        return await render_template("index.html")
+        return app.pages["index.html"].respond(Revalidate)
+
+
+@app.route("/assets/<name>")
+async def asset(name: str):
+    """Serve a fingerprinted static file."""
+    found = app.assets.get(name)
+    if found is None:
+        return "Not found", 404
+    return found.respond(Immutable)
 
 
 @app.before_serving
 async def setup():
-    store = await get_store()
-    spotify = Spotify()
+    started = time.monotonic()
+    config.settings
+    logs.setup()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, config.reload)
+    store = new_store()
+    spotify = Spotify(store, tier=Budget.Web)
     app.spotify = spotify
     app.store = store
+    app.tracks = TrackCache(store)
+    # Nothing below needs Spotify yet, so don't hold startup for it.
+    asyncio.create_task(spotify.connect())
+    _, app.assets = await asyncio.gather(
+        store.init(), asyncio.to_thread(Assets, app.static_folder))
+    app.add_template_global(app.assets.url, "asset")
+    # The player page is the same for everyone, so render it once.
+    app.pages = {"index.html": Asset(
+        (await render_template("index.html")).encode(), "text/html; charset=utf-8")}
+    logging.info("Server ready in %dms", (time.monotonic() - started) * 1000)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--config", default=None,
                         help="Supplemental config file to load")
+    parser.add_argument("-p", "--port", type=int, default=5000,
+                        help="Port to serve on")
     args = parser.parse_args()
     if args.config:
         config.load(args.config)
-    logging.basicConfig(level=config.LOG_LEVEL)
+    # Fail now, not on the first request, if anything is missing or malformed.
+    config.settings
+    logs.setup()
     logging.debug("Debug logs enabled")
-    app.run()
+    app.run(port=args.port)
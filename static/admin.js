@@ -0,0 +1,74 @@
+// Loads the follower table a page at a time, so big rooms don't block the main page.
+(() => {
+  const rows = document.querySelector("#followers tbody")
+  const more = document.getElementById("more")
+  let cursor = ""
+
+  function cell(row, text) {
+    const td = document.createElement("td")
+    td.innerText = text
+    row.appendChild(td)
+  }
+
+  function addFollower(follower) {
+    const row = document.createElement("tr")
+    row.dataset.id = follower.id
+    const td = document.createElement("td")
+    const box = document.createElement("input")
+    box.type = "checkbox"
+    td.appendChild(box)
+    row.appendChild(td)
+    cell(row, follower.id)
+    cell(row, follower.present ? "yes" : "no")
+    if (follower.last_sync === null) {
+      cell(row, "never")
+    } else {
+      const when = new Date(follower.last_sync * 1000).toLocaleTimeString()
+      cell(row, `${follower.ok ? "ok" : "failed"} at ${when}`)
+    }
+    cell(row, follower.latency_ms === null ? "" : `${follower.latency_ms}ms`)
+    rows.appendChild(row)
+  }
+
+  async function loadPage() {
+    more.disabled = true
+    const resp = await fetch(`/api/followers?cursor=${encodeURIComponent(cursor)}`)
+    if (!resp.ok) { console.log(resp); more.style.display = "none"; return }
+    const page = await resp.json()
+    page.followers.forEach(addFollower)
+    cursor = page.next
+    more.disabled = cursor === null
+    more.style.display = cursor === null ? "none" : ""
+  }
+
+  function selected() {
+    return Array.from(rows.querySelectorAll("input:checked")).map(box => box.closest("tr").dataset.id)
+  }
+
+  async function act(action) {
+    const ids = selected()
+    if (!ids.length) { return }
+    const resp = await fetch(`/api/followers/${action}`, {"method": "POST", "headers": {"Content-Type": "application/json"}, "body": JSON.stringify({"ids": ids})})
+    if (resp.ok && action == "kick") {
+      ids.forEach(id => rows.querySelector(`tr[data-id="${CSS.escape(id)}"]`).remove())
+    }
+  }
+
+  // Room controls are queued for the worker, which runs them on its next tick.
+  document.querySelectorAll("#controls button[data-command]").forEach(button => {
+    button.onclick = async () => {
+      const body = button.dataset.level ? JSON.stringify({"level": Number(button.dataset.level)}) : "{}"
+      button.disabled = true
+      try {
+        await fetch(`/api/room/${button.dataset.command}`, {"method": "POST", "headers": {"Content-Type": "application/json"}, "body": body})
+      } finally {
+        button.disabled = false
+      }
+    }
+  })
+
+  more.onclick = loadPage
+  document.getElementById("resync").onclick = () => act("resync")
+  document.getElementById("kick").onclick = () => act("kick")
+  loadPage()
+})();
@@ -2,7 +2,12 @@ window.onSpotifyWebPlaybackSDKReady = async () => {
     const player = new Spotify.Player({
       name: 'Game Night',
       getOAuthToken: async cb => { 
-        const token_resp = await fetch("/token", {"redirect":"manual"})
+        let token_resp = await fetch("/token", {"redirect":"manual"})
+        while (token_resp.status == 503) {
+          // Server is saving its API budget for syncing. Not a bad token, so wait it out.
+          await new Promise(r => setTimeout(r, 2000));
+          token_resp = await fetch("/token", {"redirect":"manual"})
+        }
         if (!token_resp.ok){ console.log(token_resp); await new Promise(r => setTimeout(r, 2000)); window.location = "/"; }
         const token = await token_resp.text()
         cb(token); }
@@ -38,15 +43,34 @@ window.onSpotifyWebPlaybackSDKReady = async () => {
       bg.style.backgroundImage = `url(${album_art(current_track,2)})` 
     });
 
+    // Presence. The worker only syncs players that have checked in recently.
+    let deviceId = null;
+    let heartbeatTimer = null;
+    function heartbeat(state) {
+      const body = JSON.stringify({"state": state, "device_id": deviceId});
+      return fetch("/heartbeat", {"method": "POST", "headers": {"Content-Type": "application/json"}, "body": body});
+    }
+
     // Ready
     player.addListener('ready', ({ device_id }) => {
       console.log('Ready with Device ID', device_id);
+      deviceId = device_id;
+      heartbeat("ready");
+      if (heartbeatTimer === null) {
+        heartbeatTimer = setInterval(() => heartbeat("ready"), 30000);
+      }
       window.onbeforeunload = () => { fetch("/logout"); }
     });
 
     // Not Ready
     player.addListener('not_ready', ({ device_id }) => {
       console.log('Device ID has gone offline', device_id);
+      heartbeat("not_ready");
+    });
+
+    // Unlike onbeforeunload, pagehide and sendBeacon are reliable in Chrome.
+    window.addEventListener('pagehide', () => {
+      navigator.sendBeacon("/heartbeat", JSON.stringify({"state": "not_ready", "device_id": deviceId}));
     });
 
     volSlider.onchange = () => {
@@ -0,0 +1,119 @@
+"""
+Static asset delivery.
+
+Everything in static/ is loaded into memory at startup, fingerprinted with a
+hash of its contents, and compressed ahead of time with gzip (and brotli, if
+it's installed). Templates link to fingerprinted URLs with the `asset` template
+global, so browsers can cache them forever; a changed file gets a new URL.
+    {{ asset("player.js") }} -> /assets/player.0c6f2b9e41d7a8f3.js
+
+Pages that look the same for every visitor are rendered once and served the
+same way, but revalidated with their ETag on each visit rather than cached
+outright.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+
+from typing import Dict, Optional
+
+from quart import Response, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Fingerprinted URLs never change content, so they can be cached for a year.
+Immutable = "public, max-age=31536000, immutable"
+# Rendered pages can change on deploy, so browsers must check back each time.
+Revalidate = "private, no-cache"
+
+
+class Asset:
+    def __init__(self, body: bytes, content_type: str):
+        """Prepare a response body in every encoding worth sending.
+
+        Parameters
+        ----------
+        body: bytes
+            Uncompressed body.
+        content_type: str
+            Content-Type header value.
+        """
+        self.content_type = content_type
+        self.fingerprint = hashlib.sha256(body).hexdigest()[:16]
+        self.variants = {"identity": body}
+        compressed = gzip.compress(body, 9, mtime=0)
+        if len(compressed) < len(body):
+            self.variants["gzip"] = compressed
+        if brotli is not None:
+            compressed = brotli.compress(body)
+            if len(compressed) < len(body):
+                self.variants["br"] = compressed
+
+    def encoding(self, accept_encoding: str) -> str:
+        """Pick the smallest variant the client accepts."""
+        accepted = set()
+        for item in accept_encoding.split(","):
+            name, _, params = item.partition(";")
+            params = params.replace(" ", "")
+            if params.startswith("q="):
+                try:
+                    if float(params[2:]) == 0:
+                        continue
+                except ValueError:
+                    continue
+            accepted.add(name.strip().lower())
+        options = [e for e in ("br", "gzip") if e in self.variants and e in accepted]
+        return min(options, key=lambda e: len(self.variants[e])) if options else "identity"
+
+    def respond(self, cache_control: str) -> Response:
+        """Build a response for the current request.
+
+        Returns 304 Not Modified if the client already has this version.
+        """
+        etag = 'W/"%s"' % self.fingerprint
+        headers = {"Cache-Control": cache_control, "ETag": etag, "Vary": "Accept-Encoding"}
+        if etag in request.headers.get("If-None-Match", ""):
+            return Response(b"", status=304, headers=headers)
+        encoding = self.encoding(request.headers.get("Accept-Encoding", ""))
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(self.variants[encoding], headers=headers, content_type=self.content_type)
+
+
+class Assets:
+    def __init__(self, static_dir: str):
+        """Load and fingerprint every file in a directory.
+
+        Parameters
+        ----------
+        static_dir: str
+            Directory to load. Subdirectories are skipped.
+        """
+        self.files: Dict[str, Asset] = {}
+        self.urls: Dict[str, str] = {}
+        for name in sorted(os.listdir(static_dir)):
+            path = os.path.join(static_dir, name)
+            if not os.path.isfile(path):
+                continue
+            with open(path, "rb") as fh:
+                body = fh.read()
+            content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+            if content_type.startswith("text/") or content_type.endswith("javascript"):
+                content_type += "; charset=utf-8"
+            asset = Asset(body, content_type)
+            stem, ext = os.path.splitext(name)
+            fingerprinted = "%s.%s%s" % (stem, asset.fingerprint, ext)
+            self.files[fingerprinted] = asset
+            self.urls[name] = "/assets/" + fingerprinted
+
+    def url(self, name: str) -> str:
+        """Fingerprinted URL for a static file, for use in templates."""
+        return self.urls.get(name, "/static/" + name)
+
+    def get(self, fingerprinted: str) -> Optional[Asset]:
+        """Look up a file by its fingerprinted name."""
+        return self.files.get(fingerprinted)
@@ -0,0 +1,147 @@
+"""
+Spotify API budget shared by the web server and worker.
+
+Both processes call Spotify with the same app credentials, so they share one
+rate limit. Every request either process makes is counted in the store, in a
+sliding window approximated from two fixed buckets (the current bucket, plus the
+previous one weighted by how much of it still overlaps the window).
+
+The worker's sync calls always go out; they're what keeps the room in sync.
+Since it never waits on the count, the worker tallies its calls locally and
+adds them to the store once per tick (see flush), rather than making a store
+round trip before every call of a fan-out. Web calls are deferred briefly, then
+shed, once usage eats into the share of the budget reserved for the worker.
+
+Config:
+    BUDGET_LIMIT: Requests allowed per window, across both processes. Default 300.
+    BUDGET_WINDOW: Window length in seconds. Default 30.
+    BUDGET_WORKER_RESERVE: Fraction of the limit only the worker may use. Default 0.25.
+    BUDGET_WEB_DEFER: Seconds a web call may wait for budget before it's shed. Default 2.
+"""
+import asyncio
+import logging
+import time
+
+from typing import Dict
+
+import tekore as tk
+
+from utils import config
+
+
+class Budget:
+    Worker = "worker"
+    Web = "web"
+
+    class Exhausted(Exception):
+        """Raised when a web call is shed for lack of budget"""
+
+    def __init__(self, store, tier: str = Worker):
+        """Set up the budget.
+
+        Parameters
+        ----------
+        store: Store
+            Store the shared counters live in.
+        tier: str
+            Budget.Worker or Budget.Web. Decides whether calls can be shed.
+        """
+        self.store = store
+        self.tier = tier
+        self.used = 0.0
+        self.unflushed = 0
+
+    # Read at use time so a config reload takes effect immediately.
+    @property
+    def limit(self) -> int:
+        return config.settings.BUDGET_LIMIT
+
+    @property
+    def window(self) -> int:
+        return config.settings.BUDGET_WINDOW
+
+    @property
+    def reserve(self) -> float:
+        return config.settings.BUDGET_WORKER_RESERVE
+
+    @property
+    def defer(self) -> float:
+        return config.settings.BUDGET_WEB_DEFER
+
+    async def _count(self, amount: int) -> float:
+        """Add to the current bucket and return the sliding window usage."""
+        now = time.time()
+        bucket, elapsed = divmod(now, self.window)
+        previous, current = await self.store.spend_budget(
+            int(bucket), amount, self.window * 2)
+        self.used = previous * (1 - elapsed / self.window) + current
+        return self.used
+
+    async def spend(self) -> None:
+        """Count one request against the budget.
+
+        The worker tier's requests are only counted locally until the next flush.
+
+        Raises
+        ------
+        Budget.Exhausted if this is a web call and the budget stays over the web
+            share for longer than BUDGET_WEB_DEFER.
+        """
+        if self.tier == self.Worker:
+            self.unflushed += 1
+            self.used += 1
+            return
+        used = await self._count(1)
+        web_limit = self.limit * (1 - self.reserve)
+        deadline = time.monotonic() + self.defer
+        while used > web_limit:
+            if time.monotonic() >= deadline:
+                logging.warning("Shedding web request, API budget at %.0f/%d", used, self.limit)
+                raise Budget.Exhausted("API budget exhausted")
+            await asyncio.sleep(min(0.5, self.defer))
+            used = await self._count(0)
+
+    async def flush(self) -> None:
+        """Add the requests counted since the last flush to the store.
+
+        Only the worker tier holds any back. Store errors are logged, and the
+        count is kept for the next flush.
+        """
+        if not self.unflushed:
+            return
+        amount, self.unflushed = self.unflushed, 0
+        try:
+            used = await self._count(amount)
+        except Exception:
+            logging.exception("Could not record API budget usage")
+            self.unflushed += amount
+            return
+        if used > self.limit:
+            logging.warning("API budget exceeded: %.0f/%d requests", used, self.limit)
+
+    async def usage(self) -> Dict[str, float]:
+        """Report current usage.
+
+        Returns
+        -------
+        {str: float}: Requests used in the current window, the limit, the web
+            tier's share of it, and the window length in seconds.
+        """
+        return {"used": round(await self._count(0), 1), "limit": self.limit,
+                "web_limit": self.limit * (1 - self.reserve), "window": self.window}
+
+
+class BudgetSender(tk.AsyncPersistentSender):
+    """Tekore sender that counts every request against a Budget.
+
+    A single sender is shared by all of a process's clients, which also lets
+    them share one HTTP connection pool.
+    """
+
+    def __init__(self, budget: Budget, client=None):
+        super().__init__(client)
+        self.budget = budget
+
+    async def send(self, request):
+        await self.budget.spend()
+        return await super().send(request)
@@ -19,15 +19,156 @@ Usage:
     >>> config.load("config.ini")
     >>> config.REDIS_HOST
     '127.0.0.1'
+    >>> config.get("REDIS_PASSWORD", "")
+    ''
+
+Known settings are also available typed and validated, from a snapshot built
+the first time `config.settings` is used. Read these on hot paths; the lookups
+above go through the environment and the config file every time.
+    >>> config.settings.REDIS_PORT
+    6379
+
+`config.reload()` re-reads any loaded config files and swaps in a new snapshot.
+Only settings marked reloadable take effect; the rest need a restart. Both
+entry points call it on SIGHUP.
 """
 import configparser
+import logging
 import os
 import sys
 from types import ModuleType
 
 
+class Setting:
+    Required = object()
+
+    def __init__(self, type_, default=Required, reloadable: bool = False, check=None):
+        """A known config item.
+
+        Parameters
+        ----------
+        type_: callable
+            Converts the raw string, e.g. int. Raises ValueError for bad values.
+        default: any
+            Value if the item isn't set. If not given, the item is required.
+        reloadable: bool
+            Whether reload() may change this setting in a running process.
+        check: callable or None
+            Called with the converted value. Raises ValueError if it's out of range.
+        """
+        self.type = type_
+        self.default = default
+        self.reloadable = reloadable
+        self.check = check
+
+
+def flag(value: str) -> bool:
+    """Parse a true/false config value."""
+    if isinstance(value, bool):
+        return value
+    if value.lower() in ("1", "true", "yes", "on"):
+        return True
+    if value.lower() in ("0", "false", "no", "off"):
+        return False
+    raise ValueError("expected true or false, got %r" % value)
+
+
+# Range checks for settings. Written as `not ...` so NaN fails them too.
+def at_least(low):
+    """Check that a value is at least `low`."""
+    def check(value):
+        if not value >= low:
+            raise ValueError("expected at least %s, got %r" % (low, value))
+    return check
+
+
+def between(low, high):
+    """Check that a value is from `low` to `high`, inclusive."""
+    def check(value):
+        if not low <= value <= high:
+            raise ValueError("expected %s to %s, got %r" % (low, high, value))
+    return check
+
+
+def positive(value):
+    """Check that a value is more than 0."""
+    if not value > 0:
+        raise ValueError("expected more than 0, got %r" % value)
+
+
+def log_level(value):
+    """Check that a value is the name of a logging level."""
+    # getLevelName maps a known level's name to its number, and anything else to a string.
+    if not isinstance(logging.getLevelName(value), int):
+        raise ValueError("expected a logging level such as INFO, got %r" % value)
+
+
+def fraction(value):
+    """Check that a value is more than 0 and at most 1."""
+    if not 0 < value <= 1:
+        raise ValueError("expected more than 0 and at most 1, got %r" % value)
+
+
+Settings = {
+    # Backends
+    "STORE_NAME": Setting(str),
+    "REDIS_HOST": Setting(str, "localhost"),
+    "REDIS_PORT": Setting(int, 6379, check=between(1, 65535)),
+    "REDIS_DB": Setting(int, 0, check=at_least(0)),
+    "FILESTORE_PATH": Setting(str, "./.store"),
+    # Spotify
+    "SPOTIFY_CLIENT_ID": Setting(str),
+    "SPOTIFY_CLIENT_SECRET": Setting(str),
+    "SPOTIFY_REDIRECT_URI": Setting(str),
+    "SPOTIFY_PROFILE_TTL": Setting(int, 24 * 3600, reloadable=True, check=at_least(0)),
+    "BUDGET_LIMIT": Setting(int, 300, reloadable=True, check=at_least(1)),
+    "BUDGET_WINDOW": Setting(int, 30, reloadable=True, check=at_least(1)),
+    "BUDGET_WORKER_RESERVE": Setting(float, 0.25, reloadable=True, check=between(0, 1)),
+    "BUDGET_WEB_DEFER": Setting(float, 2.0, reloadable=True, check=at_least(0)),
+    # Worker
+    "WORKER_INTERVAL": Setting(float, 2.0, reloadable=True, check=positive),
+    "WORKER_CONCURRENCY": Setting(int, 16, reloadable=True, check=at_least(1)),
+    "WORKER_QUORUM": Setting(float, 0.9, reloadable=True, check=fraction),
+    "WORKER_PREWARM_LEAD": Setting(float, 10.0, reloadable=True, check=at_least(0)),
+    "WORKER_QUORUM_DEADLINE": Setting(float, 1.5, reloadable=True, check=at_least(0)),
+    "PRESENCE_TTL": Setting(int, 90, reloadable=True, check=at_least(1)),
+    "SESSION_TTL": Setting(int, 30 * 24 * 3600, reloadable=True, check=at_least(1)),
+    "KICK_BAN_TTL": Setting(int, 7 * 24 * 3600, reloadable=True, check=at_least(0)),
+    "SWEEPER_INTERVAL": Setting(float, 60.0, reloadable=True, check=positive),
+    "SWEEPER_BATCH": Setting(int, 10, reloadable=True, check=at_least(1)),
+    "SWEEPER_MAX_FAILURES": Setting(int, 3, reloadable=True, check=at_least(1)),
+    "SWEEPER_BACKOFF": Setting(float, 300.0, reloadable=True, check=positive),
+    "SWEEPER_GIVE_UP": Setting(int, 10, reloadable=True, check=at_least(1)),
+    "TRACKS_CACHE_SIZE": Setting(int, 512, check=at_least(1)),
+    "TRACKS_TTL": Setting(int, 7 * 24 * 3600, reloadable=True, check=at_least(0)),
+    "EVENTS_MAX": Setting(int, 10000, reloadable=True, check=at_least(1)),
+    # Logging and diagnostics
+    "LOG_LEVEL": Setting(str.upper, "INFO", reloadable=True, check=log_level),
+    "LOG_RATE_LIMIT": Setting(int, 20, reloadable=True, check=at_least(0)),
+    "LOG_RATE_WINDOW": Setting(float, 60.0, reloadable=True, check=positive),
+    "DIAGNOSTICS_ENABLED": Setting(flag, False),
+    "DIAGNOSTICS_INTERVAL": Setting(float, 0.25, check=positive),
+    "DIAGNOSTICS_THRESHOLD": Setting(float, 0.1, check=positive),
+    "DIAGNOSTICS_PROFILE_SECONDS": Setting(float, 30.0, check=positive),
+    "DIAGNOSTICS_PROFILE_PATH": Setting(str, None),
+}
+
+
+class Snapshot:
+    """Typed config values, as attributes named after their config keys."""
+
+    def __init__(self, values):
+        self.__dict__.update(values)
+
+    def __repr__(self):
+        return "Snapshot(%s)" % ", ".join(sorted(self.__dict__))
+
+
 class ConfigModule(ModuleType):
     __config_object = configparser.ConfigParser()
+    __config_files = []
+    __settings = None
+    __reload_callbacks = []
 
     class ConfigError(Exception):
         """Generic configuration exception"""
@@ -45,6 +186,94 @@ class ConfigModule(ModuleType):
         except Exception as err:
             logging.exception("Could not read %s", config_file)
             raise ConfigModule.BadConfigFile(err)
+        self.__config_files.append(config_file)
+
+    def snapshot(self) -> Snapshot:
+        """Build a typed snapshot of every known setting.
+
+        Raises
+        ------
+        MissingConfigKey if required settings are missing, ConfigError if any
+        values can't be converted. Every problem is listed, not just the first.
+        """
+        values, missing, bad = {}, [], []
+        for key, setting in Settings.items():
+            raw = self.get(key)
+            if raw is None:
+                if setting.default is Setting.Required:
+                    missing.append(key)
+                values[key] = setting.default
+                continue
+            try:
+                values[key] = setting.type(raw)
+                if setting.check is not None:
+                    setting.check(values[key])
+            except ValueError as err:
+                bad.append("%s: %s" % (key, err))
+        if missing:
+            raise self.MissingConfigKey(
+                "Missing from environment and config file: %s" % ", ".join(missing))
+        if bad:
+            raise self.ConfigError("Bad config values: %s" % "; ".join(bad))
+        return Snapshot(values)
+
+    @property
+    def settings(self) -> Snapshot:
+        """The current typed config snapshot. Built on first use."""
+        if self.__settings is None:
+            self.__settings = self.snapshot()
+        return self.__settings
+
+    def on_reload(self, callback) -> None:
+        """Register callback(settings) to be called after a reload."""
+        self.__reload_callbacks.append(callback)
+
+    def reload(self) -> None:
+        """Re-read config files and apply any changed reloadable settings.
+
+        Changes to settings that aren't reloadable are logged and ignored. If the
+        new config doesn't validate, the current snapshot is kept.
+        """
+        config_object = configparser.ConfigParser()
+        try:
+            for config_file in self.__config_files:
+                with open(config_file) as fh:
+                    config_object.read_file(fh)
+        except Exception:
+            logging.exception("Could not re-read config, keeping current settings")
+            return
+        old_object, self.__config_object = self.__config_object, config_object
+        try:
+            new = self.snapshot()
+        except ConfigModule.ConfigError:
+            logging.exception("Reloaded config is invalid, keeping current settings")
+            self.__config_object = old_object
+            return
+        old = self.settings
+        values = dict(vars(old))
+        for key, setting in Settings.items():
+            value = getattr(new, key)
+            if value == values[key]:
+                continue
+            if setting.reloadable:
+                logging.info("Config reload: %s changed", key)
+                values[key] = value
+            else:
+                logging.warning("Config reload: %s changed, restart to apply", key)
+        self.__settings = Snapshot(values)
+        for callback in self.__reload_callbacks:
+            try:
+                callback(self.__settings)
+            except Exception:
+                logging.exception("Config reload callback failed")
+
+    def get(self, attr, default=None):
+        """Return a config item, or default if it isn't set (or is set but empty)."""
+        try:
+            value = getattr(self, attr)
+        except (AttributeError, ConfigModule.ConfigError):
+            return default
+        return default if value == "" else value
 
     def __getattr__(self, attr):
         if "_" in attr and attr != "__config_object":
@@ -0,0 +1,181 @@
+"""
+Event loop diagnostics for the sync worker.
+
+Everything in the worker shares one event loop, so anything synchronous
+(filesystem calls, JSON serialization, logging) delays the fan-out. This module
+is opt-in (set DIAGNOSTICS_ENABLED=1) and, once started:
+
+- Measures loop lag by timing a short sleep against the loop clock.
+- Turns on asyncio's slow callback reporting.
+- Samples the loop thread's stack from a watchdog thread whenever the loop
+  stalls, so we can see *what* was blocking, not just that something was.
+- Profiles the loop with cProfile for a fixed window when sent SIGUSR1.
+
+Usage:
+    >>> diagnostics = Diagnostics.from_config()
+    >>> diagnostics.start()  # from inside the running loop
+"""
+import asyncio
+import cProfile
+import io
+import logging
+import pstats
+import signal
+import sys
+import threading
+import time
+import traceback
+
+from typing import Optional
+
+from utils import config
+
+
+class Diagnostics:
+    def __init__(self, interval: float = 0.25, threshold: float = 0.1,
+                 profile_seconds: float = 30, profile_path: Optional[str] = None,
+                 report_every: float = 60):
+        """Configure the diagnostics.
+
+        Parameters
+        ----------
+        interval: float
+            Seconds between loop lag measurements.
+        threshold: float
+            Lag (and callback duration) in seconds above which we report a stall.
+        profile_seconds: float
+            How long to profile for after receiving SIGUSR1.
+        profile_path: str or None
+            If set, raw profile stats are also dumped to this path.
+        report_every: float
+            Seconds between lag summary log lines.
+        """
+        self.interval = interval
+        self.threshold = threshold
+        self.profile_seconds = profile_seconds
+        self.profile_path = profile_path
+        self.report_every = report_every
+        self._loop = None
+        self._thread_id = None
+        self._beat = time.monotonic()
+        self._sampled_beat = None
+        self._profiler = None
+        self._reset_stats()
+
+    @classmethod
+    def from_config(cls) -> Optional["Diagnostics"]:
+        """Build diagnostics from the DIAGNOSTICS config section.
+
+        Returns
+        -------
+        Diagnostics or None: None unless DIAGNOSTICS_ENABLED is set.
+        """
+        settings = config.settings
+        if not settings.DIAGNOSTICS_ENABLED:
+            return None
+        return cls(
+            interval=settings.DIAGNOSTICS_INTERVAL,
+            threshold=settings.DIAGNOSTICS_THRESHOLD,
+            profile_seconds=settings.DIAGNOSTICS_PROFILE_SECONDS,
+            profile_path=settings.DIAGNOSTICS_PROFILE_PATH,
+        )
+
+    def start(self) -> None:
+        """Start monitoring the running loop.
+
+        NOTE: this must be called from inside the loop being monitored.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._thread_id = threading.get_ident()
+        self._loop.set_debug(True)
+        self._loop.slow_callback_duration = self.threshold
+        self._loop.create_task(self._monitor())
+        threading.Thread(target=self._watchdog, name="loop-watchdog",
+                         daemon=True).start()
+        try:
+            self._loop.add_signal_handler(signal.SIGUSR1, self.profile)
+        except (NotImplementedError, AttributeError):
+            logging.warning("Signals not supported, profiling disabled")
+        logging.info("Loop diagnostics enabled (threshold %.0fms)",
+                     self.threshold * 1000)
+
+    def stats(self) -> dict:
+        """Loop lag stats since the last report, in milliseconds."""
+        count = max(self._count, 1)
+        return {"samples": self._count, "stalls": self._stalls,
+                "mean_ms": self._total / count * 1000, "max_ms": self._max * 1000}
+
+    ######
+    # Lag monitor
+    ######
+
+    def _reset_stats(self) -> None:
+        self._count, self._stalls, self._total, self._max = 0, 0, 0.0, 0.0
+
+    async def _monitor(self) -> None:
+        """Sleep for `interval` and record how late we woke up."""
+        last_report = self._loop.time()
+        while True:
+            start = self._loop.time()
+            await asyncio.sleep(self.interval)
+            now = self._loop.time()
+            self._beat = time.monotonic()
+            lag = now - start - self.interval
+            self._count += 1
+            self._total += lag
+            self._max = max(self._max, lag)
+            if lag > self.threshold:
+                self._stalls += 1
+                logging.warning("Event loop lagged %.0fms", lag * 1000)
+            if now - last_report >= self.report_every:
+                logging.info("Loop lag: %(samples)d samples, %(stalls)d stalls, "
+                             "mean %(mean_ms).1fms, max %(max_ms).1fms", self.stats())
+                self._reset_stats()
+                last_report = now
+
+    def _watchdog(self) -> None:
+        """Runs in a thread. Samples the loop's stack if it stops beating.
+
+        Only one sample is taken per stall, so a long block doesn't spam logs.
+        """
+        limit = self.interval + self.threshold
+        while True:
+            time.sleep(self.threshold / 2)
+            beat = self._beat
+            if time.monotonic() - beat < limit or beat == self._sampled_beat:
+                continue
+            self._sampled_beat = beat
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                return
+            logging.warning("Event loop blocked for over %.0fms, stack:\n%s",
+                            (time.monotonic() - beat) * 1000,
+                            "".join(traceback.format_stack(frame)))
+
+    ######
+    # Profiler
+    ######
+
+    def profile(self) -> None:
+        """Profile the loop thread for `profile_seconds`, then dump the stats.
+
+        Bound to SIGUSR1. Signals received while a profile is running are ignored.
+        """
+        if self._profiler is not None:
+            logging.info("Profile already running")
+            return
+        logging.info("Profiling for %ss", self.profile_seconds)
+        self._profiler = cProfile.Profile()
+        self._profiler.enable()
+        self._loop.call_later(self.profile_seconds, self._dump_profile)
+
+    def _dump_profile(self) -> None:
+        profiler, self._profiler = self._profiler, None
+        profiler.disable()
+        out = io.StringIO()
+        stats = pstats.Stats(profiler, stream=out)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(30)
+        logging.info("Profile results:\n%s", out.getvalue())
+        if self.profile_path:
+            stats.dump_stats(self.profile_path)
+            logging.info("Profile written to %s", self.profile_path)
@@ -0,0 +1,91 @@
+"""
+Sync event log.
+
+The worker records each leader change and fan-out outcome here. Events are
+queued in memory and written to the store in batches by a background task, so
+emitting one never waits on the store. Each store keeps a bounded log (a Redis
+stream, a rotating file, or a trimmed table) that the web server can read back.
+
+Events are flat dicts with a "kind" and a "ts" (unix time), for example:
+    {"kind": "fanout", "ts": 1603200000.0, "track": "4uLU6hMCjMI75M1A2tKUQC",
+     "followers": 12, "failed": "", "ms": 412}
+"""
+import asyncio
+import logging
+import re
+import time
+
+from typing import Dict, List, Optional, Tuple
+
+from utils import config
+
+# Redis and the file store number events "<ms>-<seq>"; SQLite uses plain integers.
+EventId = re.compile(r"\d{1,20}(-\d{1,20})?")
+
+
+class EventLog:
+    def __init__(self, store, size: int = 1000):
+        """Set up the log.
+
+        Parameters
+        ----------
+        store: Store
+            Store to write events to.
+        size: int
+            Max events waiting to be written. Past this, new events are dropped.
+        """
+        self.store = store
+        self._queue = asyncio.Queue(maxsize=size)
+        self._task = None
+
+    def start(self) -> None:
+        """Start writing events to the store in the background."""
+        self._task = asyncio.create_task(self._drain())
+
+    def emit(self, kind: str, **fields) -> None:
+        """Queue an event. Never blocks.
+
+        Parameters
+        ----------
+        kind: str
+            Type of event, e.g. "change" or "fanout".
+        fields:
+            Event data. Values should be strings or numbers.
+        """
+        try:
+            self._queue.put_nowait(dict(kind=kind, ts=round(time.time(), 3), **fields))
+        except asyncio.QueueFull:
+            logging.warning("Event log backed up, dropping %s event", kind)
+
+    async def _drain(self) -> None:
+        while True:
+            events = [await self._queue.get()]
+            while not self._queue.empty() and len(events) < 100:
+                events.append(self._queue.get_nowait())
+            try:
+                await self.store.append_events(events, config.settings.EVENTS_MAX)
+            except Exception:
+                logging.exception("Could not write %d events", len(events))
+
+
+async def read_events(store, after: Optional[str] = None, count: int = 100,
+                      wait: float = 0) -> List[Tuple[str, Dict[str, object]]]:
+    """Read events from the store's log.
+
+    Parameters
+    ----------
+    store: Store
+        Store to read from.
+    after: str or None
+        Only return events after this event ID. If None, return the latest events.
+    count: int
+        Max events to return.
+    wait: float
+        If there's nothing after `after` yet, wait up to this many seconds for
+        something to arrive. Ignored when `after` is None.
+
+    Returns
+    -------
+    [(str, dict)]: (event ID, event) pairs, oldest first.
+    """
+    return await store.read_events(after, count, wait if after else 0)
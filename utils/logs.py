@@ -0,0 +1,137 @@
+"""
+Logging setup shared by the web server and worker.
+
+Records are handed to a queue on the calling thread and formatted and written
+by a listener thread, so log I/O never blocks the event loop. Two filters keep
+the hot paths cheap and the logs safe:
+
+- RateLimit drops repeats of the same message template past a per-window
+  allowance, and reports how many were dropped once the window rolls over.
+- Redact masks anything that looks like a Spotify token. It runs on the
+  listener thread, since it has to format the message to do its job.
+
+Usage:
+    >>> from utils import logs
+    >>> logs.setup()
+"""
+import atexit
+import logging
+import logging.handlers
+import queue
+import re
+import time
+
+from typing import Dict, Optional, Tuple
+
+from utils import config
+
+_listener = None
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that defers all formatting to the listener.
+
+    The stdlib handler formats the message before queueing it, which is exactly
+    the work we're trying to move off the loop.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class RateLimit(logging.Filter):
+    def __init__(self, limit: int = 20, window: float = 60):
+        """Allow `limit` records per message template per `window` seconds.
+
+        Records at WARNING or above are never dropped.
+
+        Parameters
+        ----------
+        limit: int
+            Records allowed per template per window.
+        window: float
+            Window length in seconds.
+        """
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self._counts: Dict[Tuple[str, int, str], list] = {}
+        self._pruned = time.monotonic()
+
+    def prune(self, now: float) -> None:
+        """Forget windows that have ended, so one-off messages don't pile up."""
+        self._counts = {key: window for key, window in self._counts.items()
+                        if now - window[0] < self.window}
+        self._pruned = now
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or self.limit <= 0:
+            return True
+        key = (record.pathname, record.lineno, str(record.msg))
+        now = time.monotonic()
+        if now - self._pruned >= self.window:
+            self.prune(now)
+        window = self._counts.get(key)
+        if window is None or now - window[0] >= self.window:
+            dropped = window[2] if window else 0
+            self._counts[key] = [now, 1, 0]
+            if dropped:
+                record.msg = "%s [%d similar messages suppressed]" % (
+                    record.msg, dropped)
+            return True
+        window[1] += 1
+        if window[1] > self.limit:
+            window[2] += 1
+            return False
+        return True
+
+
+class Redact(logging.Filter):
+    # Spotify access and refresh tokens are long url-safe base64 strings.
+    # Nothing else we log (user IDs, track IDs, URIs) comes close in length.
+    TokenPattern = re.compile(r"[A-Za-z0-9_\-]{60,}")
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        message = record.getMessage()
+        redacted = self.TokenPattern.sub(
+            lambda match: match.group()[:4] + "...[redacted]", message)
+        if redacted != message:
+            record.msg, record.args = redacted, None
+        return True
+
+
+def setup(level: Optional[str] = None) -> None:
+    """Configure the root logger to log through a queue.
+
+    Safe to call more than once; only the first call does anything.
+
+    Parameters
+    ----------
+    level: str or None
+        Log level name. Defaults to LOG_LEVEL from config, or INFO.
+    """
+    global _listener
+    if _listener is not None:
+        return
+    settings = config.settings
+    level = level or settings.LOG_LEVEL
+    output = logging.StreamHandler()
+    output.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    output.addFilter(Redact())
+    log_queue = queue.SimpleQueue()
+    handler = QueueHandler(log_queue)
+    rate_limit = RateLimit(limit=settings.LOG_RATE_LIMIT, window=settings.LOG_RATE_WINDOW)
+    handler.addFilter(rate_limit)
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level)
+    _listener = logging.handlers.QueueListener(
+        log_queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+    def reconfigure(settings):
+        root.setLevel(settings.LOG_LEVEL)
+        rate_limit.limit = settings.LOG_RATE_LIMIT
+        rate_limit.window = settings.LOG_RATE_WINDOW
+    config.on_reload(reconfigure)
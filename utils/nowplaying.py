@@ -0,0 +1,84 @@
+"""
+Versioned now-playing record.
+
+The worker keeps the leader's playback as a few flat fields (track_id, playing,
+device). Changed fields are collected over a tick and written in one store
+update, which bumps the record's version. Nothing is written when nothing
+changed, so a pause doesn't rewrite the track and an idle room doesn't write at
+all.
+
+The version is a cheap change signal: the web server can compare it, or wait
+for it to move, without reading or diffing the whole record.
+"""
+import asyncio
+import logging
+import time
+
+from typing import Dict, Union
+
+Fields = Dict[str, Union[str, int]]
+
+
+class NowPlaying:
+    def __init__(self, store):
+        """Set up the record.
+
+        Parameters
+        ----------
+        store: Store
+            Store the record is written to.
+        """
+        self.store = store
+        self.fields: Fields = {}
+        self.pending: Fields = {}
+        self.version = 0
+
+    async def load(self) -> None:
+        """Pick up the stored record, so a restarted worker only writes real changes."""
+        song = await self.store.get_song()
+        self.version = int(song.pop("version", 0))
+        self.fields = dict(song)
+
+    def set(self, **fields) -> None:
+        """Stage field values. Only ones that differ from the record are written."""
+        for field, value in fields.items():
+            # Compare as strings: Redis hands every field back as one.
+            if field not in self.fields or str(self.fields[field]) != str(value):
+                self.fields[field] = value
+                self.pending[field] = value
+
+    async def flush(self) -> None:
+        """Write staged changes, if any, as a single update."""
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        try:
+            self.version = await self.store.update_song(pending)
+        except Exception:
+            logging.exception("Could not write now playing")
+            # Try again next tick.
+            self.pending = dict(pending, **self.pending)
+
+
+async def wait_song(store, version: int, wait: float, poll: float = 0.25) -> Fields:
+    """Read the now-playing record, waiting for it to change if need be.
+
+    Parameters
+    ----------
+    store: Store
+        Store to read from.
+    version: int
+        Version the caller already has.
+    wait: float
+        Max seconds to wait for a newer version before returning what's there.
+    poll: float
+        Seconds between version checks.
+
+    Returns
+    -------
+    {str: str or int}: The record, including its "version".
+    """
+    deadline = time.monotonic() + wait
+    while await store.get_song_version() <= version and time.monotonic() < deadline:
+        await asyncio.sleep(poll)
+    return await store.get_song()
@@ -5,13 +5,16 @@ These functions are somewhat opinionated, in that they provide a standard way
 of loading spotify clients and tokens. However, they are generally usage-agnostic
 and do not perform any of the actual main and follower syncing.
 """
+import asyncio
+import hashlib
 import logging
 
-from typing import Optional, Tuple
+from typing import Dict, Optional, Tuple
 
 import tekore as tk
 
 from utils import config
+from utils.budget import Budget, BudgetSender
 
 
 class Spotify:
@@ -26,26 +29,58 @@ class Spotify:
     class BadToken(Exception):
         pass
 
+    class RevokedToken(BadToken):
+        """Spotify says the refresh token is no good, and never will be"""
+
     class BadClient(Exception):
         pass
 
     class NoDevices(Exception):
         pass
 
-    def __init__(self):
-        """Read the "SPOTIFY" section from the given config path and configure the Credentials object.
+    def __init__(self, store=None, tier: str = Budget.Worker):
+        """Read the "SPOTIFY" section from the config and configure the Credentials object.
 
         Parameters
         ----------
-        config_path: str
-            Path to the configuration file.
+        store: Store or None
+            Store used to cache user profiles and track the shared API budget.
+            If None, profiles aren't cached and requests aren't counted.
+        tier: str
+            Budget.Worker or Budget.Web. Web requests are shed when the budget runs low.
         """
-        client_id = config.SPOTIFY_CLIENT_ID
-        client_secret = config.SPOTIFY_CLIENT_SECRET
-        redirect_uri = config.SPOTIFY_REDIRECT_URI
+        self.store = store
+        self.budget = Budget(store, tier) if store is not None else None
+        # One sender for every client, so they share a connection pool.
+        self.sender = BudgetSender(self.budget) if self.budget else tk.AsyncPersistentSender()
+        client_id = config.settings.SPOTIFY_CLIENT_ID
+        client_secret = config.settings.SPOTIFY_CLIENT_SECRET
+        redirect_uri = config.settings.SPOTIFY_REDIRECT_URI
         logging.info(redirect_uri)
         self.Credentials = tk.Credentials(
-            client_id, client_secret, redirect_uri, asynchronous=True)
+            client_id, client_secret, redirect_uri, sender=self.sender, asynchronous=True)
+
+    async def connect(self, timeout: float = 2) -> None:
+        """Open connections to Spotify's API and accounts hosts ahead of the first real request.
+
+        Failures are ignored; the first real request will just connect by itself.
+        These requests don't count against the budget.
+
+        Parameters
+        ----------
+        timeout: float
+            Seconds to give each host.
+        """
+        client = getattr(self.sender, "client", None)
+        if client is None:
+            return
+
+        async def touch(url: str) -> None:
+            try:
+                await client.head(url, timeout=timeout)
+            except Exception as err:
+                logging.debug("Couldn't pre-connect to %s: %s", url, err)
+        await asyncio.gather(touch("https://api.spotify.com/v1/"), touch("https://accounts.spotify.com/"))
 
     def auth_url(self, state: str) -> str:
         """Generate an authorization URL
@@ -66,9 +101,13 @@ class Spotify:
     # PLAYBACK
     ########
 
-    async def play_track(self, user: str, client: tk.Spotify, track_id: str, retry: bool = False) -> Tuple[str, bool]:
+    async def play_track(self, user: str, client: tk.Spotify, track_id: str, retry: bool = False,
+                         context_uri: Optional[str] = None, position_ms: Optional[int] = None) -> Tuple[str, bool]:
         """Play a track for a client.
 
+        If given a context (a playlist or album URI), the track is started within
+        that context, so Spotify moves the client on to the next track by itself.
+
         This method will attempt to reload the client if it fails the first time.
         Often, the token needs refreshing, or the user has changed browser windows,
         or the sun hit the clouds just wrong, or some other stupid thing. A single
@@ -85,6 +124,10 @@ class Spotify:
         retry: bool=False
             If this is a retry. If retry is set to False, a failure to play will
             trigger a user reload attempt.
+        context_uri: str or None
+            URI of the context to play the track in, or None to play it alone.
+        position_ms: int or None
+            Position to start the track at. Defaults to the beginning.
 
         Returns
         -------
@@ -92,20 +135,25 @@ class Spotify:
 
         Raises
         ------
-        Nothing. This function intentionally swallows errors.
+        Nothing. This function intentionally swallows errors, though not cancellation.
         """
         try:
-            await client.playback_start_tracks([track_id, ])
+            if context_uri:
+                await client.playback_start_context(
+                    context_uri, offset=track_id, position_ms=position_ms)
+            else:
+                await client.playback_start_tracks([track_id, ], position_ms=position_ms)
             return user, True
-        except:
+        except Exception:
             logging.exception("Error playng track for user %s", user)
             if retry:
                 return user, False
             try:
                 _, client = await self.get_user(client.token.refresh_token)
                 await self.set_device(client)
-                return await self.play_track(user, client, track_id, retry=True)
-            except:
+                return await self.play_track(user, client, track_id, retry=True,
+                                             context_uri=context_uri, position_ms=position_ms)
+            except Exception:
                 logging.exception(
                     "Error refreshing user %s during play attempt", user)
                 return user, False
@@ -129,11 +177,11 @@ class Spotify:
         """
         try:
             await client.playback_pause()
-        except:
+        except Exception:
             pass
 
-    async def get_current_track(self, client: tk.Spotify, retry: bool = False) -> Optional[tk.model.CurrentlyPlaying]:
-        """Get the currently-playing track.
+    async def get_current_track(self, client: tk.Spotify, retry: bool = False) -> Optional[tk.model.CurrentlyPlayingContext]:
+        """Get the currently-playing track, along with the device and context it's playing on.
 
         This function will retry once, attempting to reload the client to get past
         token freshness issues.
@@ -148,7 +196,7 @@ class Spotify:
 
         Returns
         -------
-        tk.model.CurrentlyPlaying or None: Info about the currently playing track. Tekore
+        tk.model.CurrentlyPlayingContext or None: Info about the current playback. Tekore
             returns None if nothing is playing, so we do as well.
 
         Raises
@@ -156,7 +204,7 @@ class Spotify:
         tk.Unauthorised if the client could not be authorized.
         """
         try:
-            current = await client.playback_currently_playing()
+            current = await client.playback()
         except tk.Unauthorised:
             if retry:
                 logging.exception("Could not get current track")
@@ -201,13 +249,13 @@ class Spotify:
         try:
             token = await self.refresh_token(token_str)
             client = await self.get_client(token)
-            user = await client.current_user()
+            profile = await self.get_profile(client, token_str)
         except Exception:
             logging.exception("Could not refresh token")
             raise
         else:
-            display_name = user.display_name
-            logging.info(f"Got client for {display_name}")
+            display_name = profile["display_name"]
+            logging.info("Got client for %s", display_name)
             return display_name, client
 
     async def get_user_id(self, token: tk.Token) -> str:
@@ -224,12 +272,58 @@ class Spotify:
         """
         try:
             client = await self.get_client(token)
-            user = await client.current_user()
+            profile = await self.get_profile(client)
         except Exception:
-            logging.exception(f"Could not get client or user from token")
+            logging.exception("Could not get client or user from token")
             raise
         else:
-            return user.id
+            return profile["id"]
+
+    @staticmethod
+    def profile_key(token_str: str) -> str:
+        """Key to cache a profile under for a refresh token.
+
+        Tokens are hashed so they never show up in store keys.
+        """
+        return hashlib.sha256(token_str.encode()).hexdigest()[:32]
+
+    async def get_profile(self, client: tk.Spotify, token_str: Optional[str] = None) -> Dict[str, str]:
+        """Get a user's ID and display name, from the store's cache if we can.
+
+        Profiles are cached by refresh token. If Spotify rotated the refresh
+        token when the client was created, the profile is cached under the new
+        one as well, so the next refresh still hits.
+
+        Parameters
+        ----------
+        client: tk.Spotify
+            Client for the user
+        token_str: str or None
+            The refresh token the client was created from, if it may differ
+            from the client's current refresh token.
+
+        Returns
+        -------
+        {str: str}: Dictionary with the user's "id" and "display_name".
+        """
+        keys = [self.profile_key(client.token.refresh_token)]
+        if token_str and token_str != client.token.refresh_token:
+            keys.append(self.profile_key(token_str))
+        profile, missing = None, []
+        if self.store is not None:
+            for key in keys:
+                profile = await self.store.get_profile(key)
+                if profile:
+                    break
+                missing.append(key)
+        if not profile:
+            user = await client.current_user()
+            profile = {"id": user.id, "display_name": user.display_name or user.id}
+            missing = keys
+        if self.store is not None:
+            for key in missing:
+                await self.store.write_profile(key, profile, config.settings.SPOTIFY_PROFILE_TTL)
+        return profile
 
     async def refresh_token(self, token_str: str) -> tk.Token:
         """Return a refreshed Token given a token refresh string
@@ -245,18 +339,31 @@ class Spotify:
 
         Raises
         ------
-        BadToken for any issues refreshing the token.
+        RevokedToken if Spotify rejected the token outright (access revoked, or the token expired).
+        BadToken for any other issues refreshing the token.
+        Budget.Exhausted if the request was shed.
         """
         try:
             token = await self.Credentials.refresh_user_token(token_str)
-        except:
+        except Budget.Exhausted:
+            raise
+        except tk.BadRequest as err:
+            try:
+                content = err.response.json()
+            except Exception:
+                content = None
+            if isinstance(content, dict) and content.get("error") == "invalid_grant":
+                logging.warning("Refresh token rejected: %s", content.get("error_description"))
+                raise Spotify.RevokedToken("Refresh token was rejected") from err
+            logging.exception("Failed to refresh token")
+            raise Spotify.BadToken("Couldn't refresh token") from err
+        except Exception as err:
             logging.exception("Failed to refresh token")
-            raise BadToken("Couldn't refresh token")
+            raise Spotify.BadToken("Couldn't refresh token") from err
         else:
             return token
 
-    @staticmethod
-    async def get_client(token: tk.Token) -> tk.Spotify:
+    async def get_client(self, token: tk.Token) -> tk.Spotify:
         """Get a spotify client from a token.
 
         Parameters
@@ -273,18 +380,20 @@ class Spotify:
         BadClient for issues creating the client.
         """
         try:
-            client = tk.Spotify(token, asynchronous=True)
+            client = tk.Spotify(token, sender=self.sender, asynchronous=True)
         except:
             logging.exception("Could not create client")
-            raise BadClient("Couldn't create client")
+            raise Spotify.BadClient("Couldn't create client")
         else:
             return client
 
     @staticmethod
-    async def set_device(client: tk.Spotify, device_name: str = "Game Night") -> None:
+    async def set_device(client: tk.Spotify, device_name: str = "Game Night", device_id: Optional[str] = None) -> str:
         """Set the active device for the client to a device that matches the provided name.
 
-        If multiple matching devices are found, the first one will be used. 
+        If multiple matching devices are found, the first one will be used. If a
+        device_id is given (say, the one we used last time), we try transferring
+        to it directly first, and only list devices if that fails.
 
         Parameters
         ----------
@@ -292,18 +401,31 @@ class Spotify:
             Client to set the device on
         device_name: str = "Game Night"
             Name of the device to make active.
+        device_id: str or None
+            ID of a device to try before looking one up by name.
+
+        Returns
+        -------
+        str: ID of the device that was made active.
 
         Raises
         ------
         NoDevices if no devices are found.
         """
+        if device_id:
+            try:
+                await client.playback_transfer(device_id)
+                return device_id
+            except tk.HTTPError:
+                logging.debug("Stored device %s is gone, looking it up", device_id)
         devices = await client.playback_devices()
         devices = [device for device in devices if device.name == device_name]
         if not devices:
-            raise NoDevices("No valid devices found")
+            raise Spotify.NoDevices("No valid devices found")
         else:
             device = devices[0].id
             await client.playback_transfer(device)
+            return device
 
     #########
     # Utility
@@ -329,13 +451,13 @@ class Spotify:
             _, client = await self.get_user(client.token.refresh_token)
         except Exception as err:
             logging.exception("Error refreshing client")
-            raise BadToken(
+            raise Spotify.BadToken(
                 "Could not refresh client using client's token") from err
         else:
             return client
 
     @staticmethod
-    def client_is_good(client: Optional[tk.Spotify], token_str: str) -> bool:
+    def client_is_good(client: Optional[tk.Spotify], token_str: str, margin: float = 0) -> bool:
         """Check if a client is still good.
 
         NOTE: this is not an async function.
@@ -350,11 +472,14 @@ class Spotify:
             Client to check if we have one.
         token_str: str
             Token from the store to check against the client
+        margin: float
+            Seconds the access token must stay valid for. Anything under 60 is
+            treated as 60.
 
         Returns
         -------
         bool: True if provided a client, that client has a token that matches
-            the provided string, and the access token has not expired.
+            the provided string, and the access token won't expire within the margin.
         """
         if client is None:
             # We got passed no client, which is obviously bad
@@ -362,7 +487,7 @@ class Spotify:
         if token_str != client.token.refresh_token:
             # The token in the client doesn't match the one on disk.
             return False
-        if client.token.is_expiring:
-            # The access token is 60sec away from expiring
+        if client.token.expires_in < max(60, margin):
+            # The access token is about to expire
             return False
         return True
@@ -3,9 +3,14 @@ import importlib
 from utils import config
 
 
-async def get_store():
+def new_store(name=None):
+    """Create a store without connecting it, so init() can overlap other setup."""
     store_module = importlib.import_module(
-        "utils.store.%s" % config.STORE_NAME)
-    store = store_module.Store()
+        "utils.store.%s" % (name or config.settings.STORE_NAME))
+    return store_module.Store()
+
+
+async def get_store(name=None):
+    store = new_store(name)
     await store.init()
     return store
@@ -4,47 +4,125 @@ Store for user tokens and current song.
 If this were a production service, this is the module that would
 handle reading and writing from the datastore. In this service,
 it reads and writes from the filesystem.
+
+All filesystem calls run in a thread, off the event loop. Every write goes to a
+temp file that is renamed into place, so a reader in the other process sees
+either the old file or the new one, never half of one.
+
+Tokens are cached in memory. A rename changes the mtime of the directory it
+lands in, so a single stat of the token directory tells us whether anything
+changed since we last looked. If something did (or the directory changed too
+recently for its mtime to be trusted) each cached token is checked against its
+own file's mtime before it's used again.
 """
-import aiofiles
-import aiofiles.os
 import asyncio
+import bisect
+import fcntl
 import json
 import logging
 import os
+import tempfile
+import threading
+import time
 
-from typing import List
+from typing import Dict, List, Optional, Set, Tuple, Union
 
 from utils import config
 
 StorePath = "./.store"
 _token_dir = "tokens"
 _song_path = "current_song"
+_profile_dir = "profiles"
+_state_path = "worker_state"
+_device_dir = "devices"
+_presence_dir = "presence"
+_session_dir = "sessions"
+_ban_dir = "bans"
+_quarantine_dir = "quarantine"
+_budget_path = "budget"
+_events_path = "events.log"
+_status_path = "follower_status"
+_commands_path = "commands"
+
+# Directory mtimes newer than this can't be trusted to catch a second write
+# in the same tick on filesystems with coarse timestamps.
+_RacyNs = 2 * 10**9
+
+
+def _read(path: str) -> Optional[str]:
+    """Read a file, returning None if it doesn't exist."""
+    try:
+        with open(path) as fh:
+            return fh.read()
+    except FileNotFoundError:
+        return None
+
+
+def _write(path: str, data: str, mtime: Optional[float] = None) -> None:
+    """Atomically replace a file's contents, optionally with a given mtime."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as fh:
+            fh.write(data)
+        if mtime is not None:
+            os.utime(tmp_path, (mtime, mtime))
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _update(path: str, update):
+    """Read-modify-write a JSON file under an exclusive lock.
+
+    For files both processes write to, where replacing the file would lose
+    updates. update is called with the current value (None if the file is new)
+    and returns (new value or None to leave the file alone, result).
+    """
+    with open(path, "a+") as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        fh.seek(0)
+        data = fh.read()
+        value, result = update(json.loads(data) if data else None)
+        if value is not None:
+            fh.seek(0)
+            fh.truncate()
+            fh.write(json.dumps(value))
+    return result
+
+
+def _remove(path: str) -> None:
+    """Remove a file, ignoring it if it's already gone."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
 
 
 class Store:
-    store_path = "./.store"
-    _token_dir = "tokens"
-    _song_path = "current_song"
-
-    async def __init__(self) -> None:
+    def __init__(self) -> None:
         """Configure the store.
 
-        Reads the "path" configuration from the STORE section
-        of the given config file. Creates the directories if necessary.
-
-        Parameters
-        ----------
-        config_path: str
-            Path to the configuration file.
+        Reads FILESTORE_PATH from the config, falling back to ./.store.
+        Directories are created by init().
         """
-        self.store_path = config.FILESTORE_PATH
-        if not os.path.isdir(self.store_path):
-            os.mkdir(self.store_path)
-        if not os.path.isdir(token_path()):
-            os.mkdir(token_path())
-
-    async def init(self):
-        pass
+        self.store_path = config.settings.FILESTORE_PATH
+        self._lock = threading.Lock()
+        self._dir_mtime = None
+        self._user_ids: Optional[List[str]] = None
+        self._tokens: Dict[str, Tuple[int, str]] = {}
+        self._verified: Set[str] = set()
+        self._last_event_id = (0, 0)
+
+    async def init(self) -> None:
+        """Create the store directories if necessary."""
+        await asyncio.to_thread(self._make_dirs)
+
+    def _make_dirs(self) -> None:
+        for path in (self.store_path, self.token_path(), self.profile_path(),
+                     self.device_path(), self.presence_path(), self.session_path(),
+                     self.quarantine_path(), self.ban_path()):
+            os.makedirs(path, exist_ok=True)
 
     def song_path(self) -> str:
         """Convenience method to get the song path"""
@@ -64,7 +142,70 @@ class Store:
         -------
         str: File path of the user's token.
         """
-        return f"{StorePath}/{_token_dir}/{user_id}"
+        return f"{self.store_path}/{_token_dir}/{user_id}"
+
+    ######
+    # Token cache. These run in a thread, under the lock.
+    ######
+
+    def _check_tokens(self) -> None:
+        """Invalidate the token cache if the token directory has changed."""
+        mtime = os.stat(self.token_path()).st_mtime_ns
+        racy = time.time_ns() - mtime < _RacyNs
+        if mtime != self._dir_mtime or racy:
+            self._dir_mtime = mtime
+            self._user_ids = None
+            self._verified.clear()
+
+    def _list_tokens(self) -> List[str]:
+        with self._lock:
+            self._check_tokens()
+            if self._user_ids is None:
+                self._user_ids = [name for name in os.listdir(self.token_path())
+                                  if not name.startswith(".")]
+                for user_id in set(self._tokens) - set(self._user_ids):
+                    del self._tokens[user_id]
+            return list(self._user_ids)
+
+    def _get_token(self, user_id: str) -> str:
+        with self._lock:
+            self._check_tokens()
+            if user_id in self._verified:
+                return self._tokens[user_id][1]
+            path = self.token_path(user_id)
+            mtime = os.stat(path).st_mtime_ns
+            cached = self._tokens.get(user_id)
+            if cached is None or cached[0] != mtime:
+                with open(path) as fh:
+                    cached = (mtime, fh.read().strip())
+                self._tokens[user_id] = cached
+            self._verified.add(user_id)
+            return cached[1]
+
+    def _get_tokens(self, user_ids: List[str]) -> Dict[str, str]:
+        tokens = {}
+        for user_id in user_ids:
+            try:
+                tokens[user_id] = self._get_token(user_id)
+            except FileNotFoundError:
+                pass
+        return tokens
+
+    def _write_token(self, user_id: str, token: str) -> None:
+        path = self.token_path(user_id)
+        with self._lock:
+            _write(path, token)
+            self._tokens[user_id] = (os.stat(path).st_mtime_ns, token)
+
+    def _delete_token(self, user_id: str) -> None:
+        with self._lock:
+            _remove(self.token_path(user_id))
+            self._tokens.pop(user_id, None)
+            self._verified.discard(user_id)
+
+    ######
+    # Tokens
+    ######
 
     async def list_tokens(self) -> List[str]:
         """List all user IDs for which we have a token.
@@ -73,7 +214,7 @@ class Store:
         -------
         List[str]: List of user IDs
         """
-        return os.listdir(token_path())
+        return await asyncio.to_thread(self._list_tokens)
 
     async def have_token(self, user_id: str) -> bool:
         """Check if we have a token for a given user ID.
@@ -87,7 +228,7 @@ class Store:
         -------
         bool: True if we have a token for the user.
         """
-        return os.path.isfile(token_path(user_id))
+        return user_id in await self.list_tokens()
 
     async def get_token(self, user_id: str) -> str:
         """Get the token for a given user ID.
@@ -105,9 +246,40 @@ class Store:
         ------
         Standard python errors for reading a file.
         """
-        async with aiofiles.open(token_path(user_id)) as fh:
-            token = await fh.read()
-        return token.strip()
+        return await asyncio.to_thread(self._get_token, user_id)
+
+    async def get_tokens(self, user_ids: List[str]) -> Dict[str, str]:
+        """Get the tokens for several users at once.
+
+        Parameters
+        ----------
+        user_ids: [str]
+            Users to get tokens for
+
+        Returns
+        -------
+        {str: str}: Mapping of user ID to token. Users without a token are left out.
+        """
+        return await asyncio.to_thread(self._get_tokens, user_ids)
+
+    async def scan_tokens(self, cursor: str, count: int) -> Tuple[Optional[str], List[str]]:
+        """Page through user IDs with tokens, in ID order.
+
+        Parameters
+        ----------
+        cursor: str
+            Last user ID of the previous page, or "" to start.
+        count: int
+            Page size
+
+        Returns
+        -------
+        (str or None, [str]): Cursor for the next page (None at the end) and this page's IDs.
+        """
+        user_ids = sorted(await self.list_tokens())
+        start = bisect.bisect_right(user_ids, cursor) if cursor else 0
+        page = user_ids[start:start + count]
+        return (page[-1] if start + count < len(user_ids) else None), page
 
     async def write_token(self, user_id: str, token: str) -> None:
         """Write a token for a given user ID.
@@ -123,12 +295,11 @@ class Store:
         ------
         Standard python errors for writing a file.
         """
-        logging.info("Writing")
-        async with aiofiles.open(token_path(user_id), "w") as fh:
-            await fh.write(token)
+        logging.debug("Writing token for %s", user_id)
+        await asyncio.to_thread(self._write_token, user_id, token)
 
     async def delete_token(self, user_id: str) -> None:
-        """Delete a token for a given user ID.
+        """Delete a token for a given user ID. Missing tokens are ignored.
 
         Parameters
         ----------
@@ -139,44 +310,635 @@ class Store:
         ------
         Standard python errors for deleting a file.
         """
-        path = token_path(user_id)
-        if await have_token(user_id):
-            await aiofiles.os.remove(path)
+        await asyncio.to_thread(self._delete_token, user_id)
+
+    ######
+    # Quarantined tokens
+    ######
+
+    def quarantine_path(self, user_id: str = "") -> str:
+        """Convenience method to get the path to a user's quarantined token"""
+        return f"{self.store_path}/{_quarantine_dir}/{user_id}"
+
+    def _quarantine_token(self, user_id: str, token: str, failures: int, retry_at: float) -> None:
+        _write(self.quarantine_path(user_id), json.dumps(
+            {"token": token, "failures": failures, "retry_at": retry_at}))
+        if _read(self.token_path(user_id)) == token:
+            self._delete_token(user_id)
+
+    def _list_quarantine(self) -> Dict[str, Dict[str, object]]:
+        quarantine = {}
+        with os.scandir(self.quarantine_path()) as entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                data = _read(entry.path)
+                if data:
+                    quarantine[entry.name] = json.loads(data)
+        return quarantine
+
+    async def quarantine_token(self, user_id: str, token: str, failures: int, retry_at: float) -> None:
+        """Move a failing token out of the live set, or update its retry schedule.
+
+        The live token is only removed if it's still the given one, so a user
+        who has logged in again in the meantime isn't affected.
 
-    async def write_song(self, song_info: str) -> None:
-        """Write the current song information to disk.
+        Parameters
+        ----------
+        user_id: str
+            User the token belongs to
+        token: str
+            The failing token
+        failures: int
+            How many times it's failed so far
+        retry_at: float
+            Unix time to try it again
+        """
+        await asyncio.to_thread(self._quarantine_token, user_id, token, failures, retry_at)
 
-        song_info is expected to be in JSON form. It is JSON and not
-        an object because tekore's .json() method produces strings.
-        However, the method will happily write whatever string you provide,
-        and then just as happily fail when you try to read it later.
+    async def list_quarantine(self) -> Dict[str, Dict[str, object]]:
+        """List quarantined tokens.
+
+        Returns
+        -------
+        {str: {str: object}}: User ID -> {"token", "failures", "retry_at"}
+        """
+        return await asyncio.to_thread(self._list_quarantine)
+
+    async def delete_quarantine(self, user_id: str) -> None:
+        """Drop a user's quarantined token. Missing ones are ignored.
 
         Parameters
         ----------
-        song_info: str
-            JSON blob to write out
+        user_id: str
+            User whose quarantined token to drop
+        """
+        await asyncio.to_thread(_remove, self.quarantine_path(user_id))
+
+    ######
+    # Now playing
+    ######
+
+    def _update_song(self, fields: Dict[str, Union[str, int]]) -> int:
+        # Only the worker writes the song, so an atomic replace is enough.
+        song_info = _read(self.song_path())
+        song = json.loads(song_info) if song_info else {}
+        song.update(fields)
+        song["version"] = int(song.get("version", 0)) + 1
+        _write(self.song_path(), json.dumps(song))
+        return song["version"]
+
+    async def update_song(self, fields: Dict[str, Union[str, int]]) -> int:
+        """Merge changed fields into the now-playing record and bump its version.
+
+        Parameters
+        ----------
+        fields: {str: str or int}
+            Fields of the now-playing record that changed
+
+        Returns
+        -------
+        int: The record's new version.
 
         Raises
         ------
         Standard Python errors for writing files.
         """
-        async with aiofiles.open(song_path(), "w") as fh:
-            await fh.write(song_info)
+        return await asyncio.to_thread(self._update_song, fields)
 
-    async def get_song(self) -> str:
-        """Read song information from disk.
+    async def get_song_version(self) -> int:
+        """Version of the now-playing record, 0 if nothing has been written yet."""
+        return int((await self.get_song()).get("version", 0))
 
-        The song information is assumed to be a json encoded object.
+    async def get_song(self) -> Dict[str, Union[str, int]]:
+        """Read song information from disk.
 
         Returns
         -------
-        dict or encodable: parsed representation of stored data.
+        {str: str or int}: The now-playing record, including its version, or
+            an empty dict if nothing has been written yet.
 
         Raises
         ------
-        Standard python errors for reading a file, standard json errors
-        for unparseable strings.
+        Standard json errors for unparseable files.
+        """
+        song_info = await asyncio.to_thread(_read, self.song_path())
+        return json.loads(song_info) if song_info else {}
+
+    async def write_track(self, track_info: Dict[str, Union[str, int]]) -> None:
+        """Track metadata isn't shared through the file store.
+
+        Each process keeps its own in-memory cache instead (see utils.tracks).
+        """
+
+    async def get_track(self, track_id: str) -> Optional[Dict[str, Union[str, int]]]:
+        """Track metadata isn't shared through the file store. Always misses."""
+        return None
+
+    ######
+    # Profiles
+    ######
+
+    def profile_path(self, key: str = "") -> str:
+        """Convenience method to get the path to a cached profile"""
+        return f"{self.store_path}/{_profile_dir}/{key}"
+
+    async def write_profile(self, key: str, profile: Dict[str, str], ttl: int) -> None:
+        """Cache a user profile.
+
+        Parameters
+        ----------
+        key: str
+            Key to cache the profile under
+        profile: {str: str}
+            The profile to cache
+        ttl: int
+            Seconds until the profile expires
+        """
+        record = {"expires": time.time() + ttl, "profile": profile}
+        await asyncio.to_thread(_write, self.profile_path(key), json.dumps(record))
+
+    async def get_profile(self, key: str) -> Optional[Dict[str, str]]:
+        """Get a cached user profile.
+
+        Parameters
+        ----------
+        key: str
+            Key the profile was cached under
+
+        Returns
+        -------
+        {str: str} or None: The profile, or None if it's missing or expired.
+        """
+        record = await asyncio.to_thread(_read, self.profile_path(key))
+        if not record:
+            return None
+        record = json.loads(record)
+        if record["expires"] < time.time():
+            return None
+        return record["profile"]
+
+    ######
+    # Worker state
+    ######
+
+    def state_path(self) -> str:
+        """Convenience method to get the worker state path"""
+        return f"{self.store_path}/{_state_path}"
+
+    async def write_state(self, state: Dict[str, object]) -> None:
+        """Checkpoint the worker's sync state.
+
+        Parameters
+        ----------
+        state: {str: object}
+            JSON-serializable worker state
+        """
+        await asyncio.to_thread(_write, self.state_path(), json.dumps(state))
+
+    async def get_state(self) -> Dict[str, object]:
+        """Read the worker's last checkpoint.
+
+        Returns
+        -------
+        {str: object}: The checkpointed state, or an empty dict if there isn't one.
+        """
+        state = await asyncio.to_thread(_read, self.state_path())
+        return json.loads(state) if state else {}
+
+    ######
+    # Devices
+    ######
+
+    def device_path(self, user_id: str = "") -> str:
+        """Convenience method to get the path to a user's last known device"""
+        return f"{self.store_path}/{_device_dir}/{user_id}"
+
+    async def write_device(self, user_id: str, device_id: str) -> None:
+        """Remember the player device a user was last synced on.
+
+        Parameters
+        ----------
+        user_id: str
+            User the device belongs to
+        device_id: str
+            Spotify device ID
+        """
+        await asyncio.to_thread(_write, self.device_path(user_id), device_id)
+
+    async def get_device(self, user_id: str) -> Optional[str]:
+        """Get the player device a user was last synced on.
+
+        Parameters
+        ----------
+        user_id: str
+            User to look up
+
+        Returns
+        -------
+        str or None: Spotify device ID, if we have one.
+        """
+        return await asyncio.to_thread(_read, self.device_path(user_id))
+
+    ######
+    # Sessions
+    ######
+
+    def session_path(self, session_id: str = "") -> str:
+        """Convenience method to get the path to a session's user ID"""
+        return f"{self.store_path}/{_session_dir}/{session_id}"
+
+    def _write_session(self, session_id: str, user_id: str, ttl: int) -> None:
+        # Like presence markers, a session file's mtime is when it expires.
+        path = self.session_path(session_id)
+        now = time.time()
+        if not os.path.exists(path):
+            # New sessions are rare enough to sweep out expired ones as we go.
+            with os.scandir(self.session_path()) as entries:
+                for entry in entries:
+                    if not entry.name.startswith(".") and entry.stat().st_mtime < now:
+                        _remove(entry.path)
+        _write(path, user_id, mtime=now + ttl)
+
+    def _get_session(self, session_id: str) -> Optional[str]:
+        path = self.session_path(session_id)
+        try:
+            if os.stat(path).st_mtime < time.time():
+                return None
+        except FileNotFoundError:
+            return None
+        return _read(path)
+
+    async def write_session(self, session_id: str, user_id: str, ttl: int) -> None:
+        """Remember which user a web session belongs to, for ttl seconds.
+
+        Parameters
+        ----------
+        session_id: str
+            ID from the session cookie
+        user_id: str
+            User who logged in with it
+        ttl: int
+            Seconds until the session is forgotten, unless written again
+        """
+        await asyncio.to_thread(self._write_session, session_id, user_id, ttl)
+
+    async def get_session(self, session_id: str) -> Optional[str]:
+        """Look up which user a web session belongs to.
+
+        Parameters
+        ----------
+        session_id: str
+            ID from the session cookie
+
+        Returns
+        -------
+        str or None: The user's ID, or None if the session is unknown or expired.
+        """
+        return await asyncio.to_thread(self._get_session, session_id)
+
+    async def pop_session(self, session_id: str) -> Optional[str]:
+        """Forget a web session.
+
+        Parameters
+        ----------
+        session_id: str
+            ID from the session cookie
+
+        Returns
+        -------
+        str or None: The user it belonged to, if it was known and unexpired.
+        """
+        user_id = await self.get_session(session_id)
+        await asyncio.to_thread(_remove, self.session_path(session_id))
+        return user_id
+
+    def _delete_sessions(self, user_id: str) -> None:
+        with os.scandir(self.session_path()) as entries:
+            for entry in entries:
+                if not entry.name.startswith(".") and _read(entry.path) == user_id:
+                    _remove(entry.path)
+
+    async def delete_sessions(self, user_id: str) -> None:
+        """Forget every web session a user has.
+
+        Parameters
+        ----------
+        user_id: str
+            User whose sessions to end
+        """
+        await asyncio.to_thread(self._delete_sessions, user_id)
+
+    def ban_path(self, user_id: str = "") -> str:
+        """Convenience method to get the path to a user's ban marker"""
+        return f"{self.store_path}/{_ban_dir}/{user_id}"
+
+    def _write_ban(self, user_id: str, ttl: int) -> None:
+        # Like presence markers, a ban marker's mtime is when it expires.
+        now = time.time()
+        with os.scandir(self.ban_path()) as entries:
+            for entry in entries:
+                if not entry.name.startswith(".") and entry.stat().st_mtime < now:
+                    _remove(entry.path)
+        _write(self.ban_path(user_id), "", mtime=now + ttl)
+
+    def _is_banned(self, user_id: str) -> bool:
+        try:
+            return os.stat(self.ban_path(user_id)).st_mtime >= time.time()
+        except FileNotFoundError:
+            return False
+
+    async def write_ban(self, user_id: str, ttl: int) -> None:
+        """Keep a user from logging back in for ttl seconds.
+
+        Parameters
+        ----------
+        user_id: str
+            User to ban
+        ttl: int
+            Seconds until the ban lifts
+        """
+        await asyncio.to_thread(self._write_ban, user_id, ttl)
+
+    async def is_banned(self, user_id: str) -> bool:
+        """Check whether a user is banned.
+
+        Parameters
+        ----------
+        user_id: str
+            User to check
+
+        Returns
+        -------
+        bool: True if the user has an unexpired ban.
+        """
+        return await asyncio.to_thread(self._is_banned, user_id)
+
+    ######
+    # Presence
+    ######
+
+    def presence_path(self, user_id: str = "") -> str:
+        """Convenience method to get the path to a user's presence marker"""
+        return f"{self.store_path}/{_presence_dir}/{user_id}"
+
+    def _write_presence(self, user_id: str, ttl: int) -> None:
+        # The marker's mtime is set to when it expires, so listing presence
+        # is a single scandir with no reads.
+        path = self.presence_path(user_id)
+        with open(path, "a"):
+            pass
+        expires = time.time() + ttl
+        os.utime(path, (expires, expires))
+
+    def _list_present(self) -> List[str]:
+        now = time.time()
+        with os.scandir(self.presence_path()) as entries:
+            return [entry.name for entry in entries
+                    if not entry.name.startswith(".") and entry.stat().st_mtime >= now]
+
+    async def write_presence(self, user_id: str, ttl: int) -> None:
+        """Mark a user's player as present for the next ttl seconds.
+
+        Parameters
+        ----------
+        user_id: str
+            User whose player checked in
+        ttl: int
+            Seconds until the user is considered gone
+        """
+        await asyncio.to_thread(self._write_presence, user_id, ttl)
+
+    async def delete_presence(self, user_id: str) -> None:
+        """Mark a user's player as gone.
+
+        Parameters
+        ----------
+        user_id: str
+            User whose player went away
+        """
+        await asyncio.to_thread(_remove, self.presence_path(user_id))
+
+    async def list_present(self) -> List[str]:
+        """List users whose players have checked in within their TTL.
+
+        Returns
+        -------
+        [str]: IDs of present users.
+        """
+        return await asyncio.to_thread(self._list_present)
+
+    ######
+    # API budget
+    ######
+
+    def budget_path(self) -> str:
+        """Convenience method to get the API budget counter path"""
+        return f"{self.store_path}/{_budget_path}"
+
+    def _spend_budget(self, bucket: int, amount: int) -> Tuple[int, int]:
+        def spend(counts):
+            counts = {key: count for key, count in (counts or {}).items()
+                      if int(key) >= bucket - 1}
+            counts[str(bucket)] = counts.get(str(bucket), 0) + amount
+            return (counts if amount else None), (counts.get(str(bucket - 1), 0), counts[str(bucket)])
+        return _update(self.budget_path(), spend)
+
+    async def spend_budget(self, bucket: int, amount: int, ttl: int) -> Tuple[int, int]:
+        """Add to an API budget bucket.
+
+        Parameters
+        ----------
+        bucket: int
+            Index of the current bucket
+        amount: int
+            Requests to add. 0 just reads the counts.
+        ttl: int
+            Unused. Buckets older than the previous one are dropped on write.
+
+        Returns
+        -------
+        (int, int): Counts for the previous and current buckets.
+        """
+        return await asyncio.to_thread(self._spend_budget, bucket, amount)
+
+    ######
+    # Event log
+    ######
+
+    def events_path(self) -> str:
+        """Convenience method to get the event log path"""
+        return f"{self.store_path}/{_events_path}"
+
+    def _next_event_id(self) -> str:
+        # IDs are "<ms>-<seq>" like Redis stream IDs, increasing even if the clock doesn't.
+        ms = int(time.time() * 1000)
+        last_ms, seq = self._last_event_id
+        self._last_event_id = (ms, 0) if ms > last_ms else (last_ms, seq + 1)
+        return "%d-%d" % self._last_event_id
+
+    def _append_events(self, events: List[Dict[str, object]], max_len: int) -> None:
+        path = self.events_path()
+        lines = "".join(json.dumps(dict(event, id=self._next_event_id())) + "\n"
+                        for event in events)
+        with open(path, "a") as fh:
+            fh.write(lines)
+            size = fh.tell()
+        # Events run ~100 bytes, so this keeps between max_len and 2 * max_len of them.
+        if size > max_len * 100:
+            os.replace(path, path + ".1")
+
+    @staticmethod
+    def _parse_events(data: bytes, after: Optional[str]) -> Tuple[List[Dict[str, object]], int]:
+        # Only whole lines: the worker may be halfway through appending the last one.
+        end = data.rfind(b"\n") + 1
+        events = [json.loads(line) for line in data[:end].splitlines() if line]
+        if after is not None:
+            after = tuple(int(part) for part in after.split("-"))
+            events = [event for event in events
+                      if tuple(int(part) for part in event["id"].split("-")) > after]
+        return events, end
+
+    def _read_events(self, after: Optional[str]) -> Tuple[List[Dict[str, object]], Tuple[Optional[int], int]]:
+        """Read both log files. Also returns the log's (inode, offset) read up to, for _tail_events."""
+        try:
+            with open(self.events_path() + ".1", "rb") as fh:
+                events = self._parse_events(fh.read(), after)[0]
+        except FileNotFoundError:
+            events = []
+        try:
+            with open(self.events_path(), "rb") as fh:
+                inode = os.fstat(fh.fileno()).st_ino
+                more, offset = self._parse_events(fh.read(), after)
+        except FileNotFoundError:
+            return events, (None, 0)
+        return events + more, (inode, offset)
+
+    def _tail_events(self, after: Optional[str], position: Tuple[Optional[int], int]
+                     ) -> Optional[Tuple[List[Dict[str, object]], Tuple[Optional[int], int]]]:
+        """Read events appended to the log since `position`.
+
+        Returns None if the log has been rotated since, in which case it needs reading again in full.
+        """
+        inode, offset = position
+        try:
+            with open(self.events_path(), "rb") as fh:
+                if os.fstat(fh.fileno()).st_ino != inode:
+                    return None
+                fh.seek(offset)
+                events, read = self._parse_events(fh.read(), after)
+        except FileNotFoundError:
+            return ([], position) if inode is None else None
+        return events, (inode, offset + read)
+
+    async def append_events(self, events: List[Dict[str, object]], max_len: int) -> None:
+        """Append events to the log, rotating it once it gets too big.
+
+        Only the worker writes events, so appends don't need a lock.
+
+        Parameters
+        ----------
+        events: [dict]
+            Events to append
+        max_len: int
+            Roughly how many events to keep
+        """
+        await asyncio.to_thread(self._append_events, events, max_len)
+
+    async def read_events(self, after: Optional[str], count: int,
+                          wait: float) -> List[Tuple[str, Dict[str, object]]]:
+        """Read events from the log.
+
+        Parameters
+        ----------
+        after: str or None
+            Only return events after this ID. If None, return the latest events.
+        count: int
+            Max events to return
+        wait: float
+            Seconds to poll for new events if there are none after `after` yet.
+
+        Returns
+        -------
+        [(str, dict)]: (event ID, event) pairs, oldest first.
+        """
+        deadline = time.monotonic() + wait
+        events, position = await asyncio.to_thread(self._read_events, after)
+        while not events and time.monotonic() < deadline:
+            await asyncio.sleep(0.5)
+            # Only read what's been appended since, unless the log was rotated meanwhile.
+            tail = await asyncio.to_thread(self._tail_events, after, position)
+            if tail is None:
+                tail = await asyncio.to_thread(self._read_events, after)
+            events, position = tail
+        events = events[:count] if after is not None else events[-count:]
+        return [(event.pop("id"), event) for event in events]
+
+    ######
+    # Follower status
+    ######
+
+    def status_path(self) -> str:
+        """Convenience method to get the follower status path"""
+        return f"{self.store_path}/{_status_path}"
+
+    def _write_statuses(self, statuses: Dict[str, Dict[str, object]]) -> None:
+        current = json.loads(_read(self.status_path()) or "{}")
+        current.update(statuses)
+        _write(self.status_path(), json.dumps(current))
+
+    async def write_statuses(self, statuses: Dict[str, Dict[str, object]]) -> None:
+        """Record the latest sync outcome for some followers.
+
+        Only the worker writes statuses, so this doesn't need a lock.
+
+        Parameters
+        ----------
+        statuses: {str: dict}
+            Mapping of user ID to status
+        """
+        await asyncio.to_thread(self._write_statuses, statuses)
+
+    async def get_statuses(self, user_ids: List[str]) -> Dict[str, Dict[str, object]]:
+        """Get the latest sync outcome for some followers.
+
+        Parameters
+        ----------
+        user_ids: [str]
+            Users to look up
+
+        Returns
+        -------
+        {str: dict}: Mapping of user ID to status. Users never synced are left out.
+        """
+        statuses = json.loads(await asyncio.to_thread(_read, self.status_path()) or "{}")
+        return {user_id: statuses[user_id] for user_id in user_ids if user_id in statuses}
+
+    ######
+    # Commands
+    ######
+
+    def commands_path(self) -> str:
+        """Convenience method to get the command queue path"""
+        return f"{self.store_path}/{_commands_path}"
+
+    async def push_commands(self, commands: List[Dict[str, object]]) -> None:
+        """Queue commands for the worker.
+
+        Parameters
+        ----------
+        commands: [dict]
+            Commands to queue
+        """
+        await asyncio.to_thread(
+            _update, self.commands_path(), lambda queued: ((queued or []) + commands, None))
+
+    async def pop_commands(self) -> List[Dict[str, object]]:
+        """Take every queued command.
+
+        Returns
+        -------
+        [dict]: Queued commands, oldest first.
         """
-        async with aiofiles.open(song_path()) as fh:
-            song_info = await fh.read()
-        return json.loads(song_info)
+        return await asyncio.to_thread(
+            _update, self.commands_path(), lambda queued: (([] if queued else None), queued or []))
@@ -1,18 +1,25 @@
 import aioredis
 
+import asyncio
 import json
 import logging
+import time
 
-from typing import List
+from typing import Dict, List, Optional, Tuple, Union
 
 from utils import config
 
 
 class Store:
+    # Each blocking event read holds a pooled connection (of 10, by default) while it waits.
+    # Past this many at once, waiters poll instead, so they can't starve other commands.
+    MaxBlockingReads = 3
+
     async def init(self):
+        self._blocking_reads = asyncio.Semaphore(self.MaxBlockingReads)
         self._redis = await aioredis.create_redis_pool(
-            (config.REDIS_HOST, int(config.REDIS_PORT)),
-            db=int(config.REDIS_DB),
+            (config.settings.REDIS_HOST, config.settings.REDIS_PORT),
+            db=config.settings.REDIS_DB,
             encoding="utf-8",
         )
         try:
@@ -23,6 +30,19 @@ class Store:
         else:
             logging.info("Connected to redis on %s:%s/%s",
                          self._redis.address[0], self._redis.address[1], self._redis.db)
+        await self.index_tokens()
+
+    async def index_tokens(self) -> None:
+        """Build the token index from the token keys, if it doesn't exist yet.
+
+        Token listings are served from the index so they never need KEYS. This
+        only scans keys once, for stores written before the index existed.
+        """
+        if await self._redis.exists(self.token_index_path()):
+            return
+        user_ids = [key.partition("/")[2] async for key in self._redis.iscan(match=self.token_path("*"))]
+        if user_ids:
+            await self._redis.zadd(self.token_index_path(), *[x for user_id in user_ids for x in (0, user_id)])
 
     def song_path(self) -> str:
         return "current_song"
@@ -30,11 +50,18 @@ class Store:
     def token_path(self, user_id: str = "") -> str:
         return f"token/{user_id}"
 
+    def token_index_path(self) -> str:
+        return "tokens"
+
     async def list_tokens(self) -> List[str]:
-        tokens = await self._redis.keys(self.token_path("*"))
-        logging.info(tokens)
-        logging.info([token.partition("/")[2] for token in tokens])
-        return [token.partition("/")[2] for token in tokens]
+        return await self._redis.zrange(self.token_index_path())
+
+    async def scan_tokens(self, cursor: str, count: int) -> Tuple[Optional[str], List[str]]:
+        # All scores are 0, so the index sorts by user ID and a user ID is a stable cursor.
+        user_ids = await self._redis.zrangebylex(
+            self.token_index_path(), min=cursor.encode() if cursor else b"-", include_min=False,
+            offset=0, count=count)
+        return (user_ids[-1] if len(user_ids) == count else None), user_ids
 
     async def have_token(self, user_id: str) -> bool:
         return bool(await self._redis.exists(self.token_path(user_id)))
@@ -47,15 +74,227 @@ class Store:
         else:
             return token
 
+    async def get_tokens(self, user_ids: List[str]) -> Dict[str, str]:
+        if not user_ids:
+            return {}
+        tokens = await self._redis.mget(*[self.token_path(user_id) for user_id in user_ids])
+        return {user_id: token for user_id, token in zip(user_ids, tokens) if token}
+
     async def write_token(self, user_id: str, token: str) -> None:
-        await self._redis.set(self.token_path(user_id), token)
+        transaction = self._redis.multi_exec()
+        transaction.set(self.token_path(user_id), token)
+        transaction.zadd(self.token_index_path(), 0, user_id)
+        await transaction.execute()
 
     async def delete_token(self, user_id: str) -> None:
-        await self._redis.delete(self.token_path(user_id))
+        transaction = self._redis.multi_exec()
+        transaction.delete(self.token_path(user_id))
+        transaction.zrem(self.token_index_path(), user_id)
+        await transaction.execute()
+
+    def quarantine_path(self) -> str:
+        return "quarantine"
+
+    async def quarantine_token(self, user_id: str, token: str, failures: int, retry_at: float) -> None:
+        await self._redis.hset(self.quarantine_path(), user_id, json.dumps(
+            {"token": token, "failures": failures, "retry_at": retry_at}))
+        if await self._redis.get(self.token_path(user_id)) == token:
+            await self.delete_token(user_id)
+
+    async def list_quarantine(self) -> Dict[str, Dict[str, object]]:
+        quarantine = await self._redis.hgetall(self.quarantine_path())
+        return {user_id: json.loads(entry) for user_id, entry in quarantine.items()}
+
+    async def delete_quarantine(self, user_id: str) -> None:
+        await self._redis.hdel(self.quarantine_path(), user_id)
+
+    async def update_song(self, fields: Dict[str, Union[str, int]]) -> int:
+        song = self.song_path()
+        transaction = self._redis.multi_exec()
+        transaction.hmset_dict(song, fields)
+        version = transaction.hincrby(song, "version", 1)
+        await transaction.execute()
+        return await version
+
+    async def get_song_version(self) -> int:
+        return int(await self._redis.hget(self.song_path(), "version") or 0)
+
+    async def get_song(self) -> Dict[str, str]:
+        return await self._redis.hgetall(self.song_path())
+
+    def track_path(self, track_id: str) -> str:
+        return f"track/{track_id}"
+
+    async def write_track(self, track_info: Dict[str, Union[str, int]]) -> None:
+        await self._redis.set(self.track_path(track_info["id"]), json.dumps(track_info),
+                              expire=config.settings.TRACKS_TTL)
+
+    async def get_track(self, track_id: str) -> Optional[Dict[str, Union[str, int]]]:
+        track_info = await self._redis.get(self.track_path(track_id))
+        return json.loads(track_info) if track_info else None
+
+    def profile_path(self, key: str) -> str:
+        return f"profile/{key}"
+
+    async def write_profile(self, key: str, profile: Dict[str, str], ttl: int) -> None:
+        await self._redis.set(self.profile_path(key), json.dumps(profile), expire=ttl)
+
+    async def get_profile(self, key: str) -> Optional[Dict[str, str]]:
+        profile = await self._redis.get(self.profile_path(key))
+        return json.loads(profile) if profile else None
+
+    def state_path(self) -> str:
+        return "worker_state"
+
+    async def write_state(self, state: Dict[str, object]) -> None:
+        await self._redis.set(self.state_path(), json.dumps(state))
+
+    async def get_state(self) -> Dict[str, object]:
+        state = await self._redis.get(self.state_path())
+        return json.loads(state) if state else {}
+
+    def device_path(self, user_id: str) -> str:
+        return f"device/{user_id}"
+
+    async def write_device(self, user_id: str, device_id: str) -> None:
+        await self._redis.set(self.device_path(user_id), device_id)
+
+    async def get_device(self, user_id: str) -> Optional[str]:
+        return await self._redis.get(self.device_path(user_id))
+
+    def session_path(self, session_id: str) -> str:
+        return f"session/{session_id}"
+
+    def user_sessions_path(self, user_id: str) -> str:
+        return f"user_sessions/{user_id}"
+
+    async def write_session(self, session_id: str, user_id: str, ttl: int) -> None:
+        transaction = self._redis.multi_exec()
+        transaction.set(self.session_path(session_id), user_id, expire=ttl)
+        # Index sessions by user, so they can all be ended at once.
+        transaction.sadd(self.user_sessions_path(user_id), session_id)
+        transaction.expire(self.user_sessions_path(user_id), ttl)
+        await transaction.execute()
+
+    async def get_session(self, session_id: str) -> Optional[str]:
+        return await self._redis.get(self.session_path(session_id))
+
+    async def pop_session(self, session_id: str) -> Optional[str]:
+        transaction = self._redis.multi_exec()
+        user_id = transaction.get(self.session_path(session_id))
+        transaction.delete(self.session_path(session_id))
+        await transaction.execute()
+        return await user_id
+
+    async def delete_sessions(self, user_id: str) -> None:
+        session_ids = await self._redis.smembers(self.user_sessions_path(user_id))
+        await self._redis.delete(self.user_sessions_path(user_id),
+                                 *[self.session_path(session_id) for session_id in session_ids])
+
+    def bans_path(self) -> str:
+        return "bans"
+
+    async def write_ban(self, user_id: str, ttl: int) -> None:
+        now = time.time()
+        transaction = self._redis.multi_exec()
+        transaction.zremrangebyscore(self.bans_path(), max=now)
+        transaction.zadd(self.bans_path(), now + ttl, user_id)
+        await transaction.execute()
+
+    async def is_banned(self, user_id: str) -> bool:
+        expires = await self._redis.zscore(self.bans_path(), user_id)
+        return expires is not None and float(expires) >= time.time()
+
+    def presence_path(self) -> str:
+        return "presence"
+
+    async def write_presence(self, user_id: str, ttl: int) -> None:
+        await self._redis.zadd(self.presence_path(), time.time() + ttl, user_id)
+
+    async def delete_presence(self, user_id: str) -> None:
+        await self._redis.zrem(self.presence_path(), user_id)
+
+    async def list_present(self) -> List[str]:
+        now = time.time()
+        transaction = self._redis.multi_exec()
+        transaction.zremrangebyscore(self.presence_path(), max=now)
+        present = transaction.zrangebyscore(self.presence_path(), min=now)
+        await transaction.execute()
+        return await present
+
+    def budget_path(self, bucket: int) -> str:
+        return f"budget/{bucket}"
+
+    async def spend_budget(self, bucket: int, amount: int, ttl: int) -> Tuple[int, int]:
+        transaction = self._redis.multi_exec()
+        previous = transaction.get(self.budget_path(bucket - 1))
+        current = transaction.incrby(self.budget_path(bucket), amount)
+        transaction.expire(self.budget_path(bucket), ttl)
+        await transaction.execute()
+        return int(await previous or 0), await current
+
+    def events_path(self) -> str:
+        return "events"
+
+    async def append_events(self, events: List[Dict[str, object]], max_len: int) -> None:
+        transaction = self._redis.multi_exec()
+        for event in events:
+            transaction.xadd(self.events_path(), {"e": json.dumps(event)},
+                             max_len=max_len, exact_len=False)
+        await transaction.execute()
+
+    async def _events_after(self, stream: str, after: str, count: int) -> List[Tuple[str, Dict[str, str]]]:
+        # XRANGE is inclusive, so ask for one extra and drop `after` itself.
+        return [(event_id, fields) for event_id, fields
+                in await self._redis.xrange(stream, start=after, count=count + 1)
+                if event_id != after][:count]
+
+    async def read_events(self, after: Optional[str], count: int,
+                          wait: float) -> List[Tuple[str, Dict[str, object]]]:
+        stream = self.events_path()
+        if after is None:
+            entries = list(reversed(await self._redis.xrevrange(stream, count=count)))
+        else:
+            entries = await self._events_after(stream, after, count)
+            if not entries and wait > 0 and not self._blocking_reads.locked():
+                async with self._blocking_reads:
+                    # A blocking read holds its connection, so take one of our own rather than
+                    # stalling everyone else's commands behind it. BLOCK 0 would mean forever.
+                    with await self._redis as conn:
+                        entries = [(event_id, fields) for _, event_id, fields in await conn.xread(
+                            [stream], timeout=max(1, round(wait * 1000)), count=count, latest_ids=[after])]
+            elif not entries and wait > 0:
+                deadline = time.monotonic() + wait
+                while not entries and time.monotonic() < deadline:
+                    await asyncio.sleep(0.5)
+                    entries = await self._events_after(stream, after, count)
+        return [(event_id, json.loads(fields["e"])) for event_id, fields in entries]
+
+    def status_path(self) -> str:
+        return "follower_status"
+
+    async def write_statuses(self, statuses: Dict[str, Dict[str, object]]) -> None:
+        if statuses:
+            await self._redis.hmset_dict(self.status_path(), {
+                user_id: json.dumps(status) for user_id, status in statuses.items()})
+
+    async def get_statuses(self, user_ids: List[str]) -> Dict[str, Dict[str, object]]:
+        if not user_ids:
+            return {}
+        statuses = await self._redis.hmget(self.status_path(), *user_ids)
+        return {user_id: json.loads(status)
+                for user_id, status in zip(user_ids, statuses) if status}
+
+    def commands_path(self) -> str:
+        return "commands"
 
-    async def write_song(self, song_info: str) -> None:
-        # TODO: This should be taking a flat dictionary, not JSON
-        await self._redis.set(self.song_path(), song_info)
+    async def push_commands(self, commands: List[Dict[str, object]]) -> None:
+        if commands:
+            await self._redis.rpush(self.commands_path(), *[json.dumps(command) for command in commands])
 
-    async def get_song(self) -> str:
-        await self._redis.get(self.song_path())
+    async def pop_commands(self) -> List[Dict[str, object]]:
+        transaction = self._redis.multi_exec()
+        commands = transaction.lrange(self.commands_path(), 0, -1)
+        transaction.delete(self.commands_path())
+        await transaction.execute()
+        return [json.loads(command) for command in await commands]
@@ -0,0 +1,401 @@
+"""
+SQLite store for single-node deployments.
+
+A middle ground between the file store and Redis: one database file shared by
+the web server and worker, with WAL journaling so readers never block the
+writer (or each other). Every query runs on a dedicated thread that owns the
+connection, so nothing blocks the event loop and the connection is never
+shared across threads.
+
+Reads FILESTORE_PATH for the directory to keep the database in, same as the
+file store.
+"""
+import asyncio
+import json
+import os
+import sqlite3
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple, Union
+
+from utils import config
+
+_db_name = "store.sqlite3"
+
+Schema = """
+CREATE TABLE IF NOT EXISTS tokens (
+    user_id TEXT PRIMARY KEY,
+    token TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS quarantine (
+    user_id TEXT PRIMARY KEY,
+    token TEXT NOT NULL,
+    failures INTEGER NOT NULL,
+    retry_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS devices (
+    user_id TEXT PRIMARY KEY,
+    device_id TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS song (
+    field TEXT PRIMARY KEY,
+    value
+);
+CREATE TABLE IF NOT EXISTS tracks (
+    track_id TEXT PRIMARY KEY,
+    info TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tracks_expires ON tracks (expires);
+CREATE TABLE IF NOT EXISTS profiles (
+    key TEXT PRIMARY KEY,
+    profile TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS profiles_expires ON profiles (expires);
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires);
+CREATE INDEX IF NOT EXISTS sessions_user ON sessions (user_id);
+CREATE TABLE IF NOT EXISTS bans (
+    user_id TEXT PRIMARY KEY,
+    expires REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS presence (
+    user_id TEXT PRIMARY KEY,
+    expires REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS presence_expires ON presence (expires);
+CREATE TABLE IF NOT EXISTS budget (
+    bucket INTEGER PRIMARY KEY,
+    count INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    event TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS statuses (
+    user_id TEXT PRIMARY KEY,
+    status TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS commands (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    command TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+class Store:
+    def __init__(self) -> None:
+        """Configure the store. The database is opened by init()."""
+        self.store_path = config.settings.FILESTORE_PATH
+        self.db_path = os.path.join(self.store_path, _db_name)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._db = None
+
+    async def init(self) -> None:
+        """Open the database, enable WAL and create any missing tables."""
+        await self._run(self._connect)
+
+    def _connect(self) -> None:
+        os.makedirs(self.store_path, exist_ok=True)
+        self._db = sqlite3.connect(self.db_path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # With WAL, NORMAL only risks the last transactions on power loss, not corruption.
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("PRAGMA busy_timeout=5000")
+        self._db.executescript(Schema)
+
+    async def _run(self, fn, *args):
+        """Run fn on the database thread."""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def _query(self, sql: str, *params) -> List[tuple]:
+        """Run a read query and return all rows."""
+        return await self._run(lambda: self._db.execute(sql, params).fetchall())
+
+    async def _write(self, *statements) -> None:
+        """Run (sql, params) statements in a single transaction."""
+        def transaction():
+            with self._db:
+                for sql, params in statements:
+                    self._db.execute(sql, params)
+        await self._run(transaction)
+
+    ######
+    # Tokens
+    ######
+
+    async def list_tokens(self) -> List[str]:
+        return [row[0] for row in await self._query("SELECT user_id FROM tokens")]
+
+    async def have_token(self, user_id: str) -> bool:
+        return bool(await self._query("SELECT 1 FROM tokens WHERE user_id = ?", user_id))
+
+    async def get_token(self, user_id: str) -> str:
+        rows = await self._query("SELECT token FROM tokens WHERE user_id = ?", user_id)
+        if not rows:
+            # TODO: Fix exceptions.
+            raise Exception("No token for user %s" % user_id)
+        return rows[0][0]
+
+    async def get_tokens(self, user_ids: List[str]) -> Dict[str, str]:
+        if not user_ids:
+            return {}
+        def select():
+            # Stay well under SQLite's bound parameter limit.
+            tokens = {}
+            for start in range(0, len(user_ids), 500):
+                batch = user_ids[start:start + 500]
+                tokens.update(self._db.execute(
+                    "SELECT user_id, token FROM tokens WHERE user_id IN (%s)"
+                    % ",".join("?" * len(batch)), batch))
+            return tokens
+        return await self._run(select)
+
+    async def scan_tokens(self, cursor: str, count: int) -> Tuple[Optional[str], List[str]]:
+        user_ids = [row[0] for row in await self._query(
+            "SELECT user_id FROM tokens WHERE user_id > ? ORDER BY user_id LIMIT ?", cursor, count)]
+        return (user_ids[-1] if len(user_ids) == count else None), user_ids
+
+    async def write_token(self, user_id: str, token: str) -> None:
+        await self._write((
+            "INSERT INTO tokens (user_id, token, updated) VALUES (?, ?, ?) "
+            "ON CONFLICT (user_id) DO UPDATE SET token = excluded.token, updated = excluded.updated",
+            (user_id, token, time.time())))
+
+    async def delete_token(self, user_id: str) -> None:
+        await self._write(("DELETE FROM tokens WHERE user_id = ?", (user_id,)))
+
+    async def quarantine_token(self, user_id: str, token: str, failures: int, retry_at: float) -> None:
+        await self._write(
+            ("INSERT OR REPLACE INTO quarantine (user_id, token, failures, retry_at) VALUES (?, ?, ?, ?)",
+             (user_id, token, failures, retry_at)),
+            ("DELETE FROM tokens WHERE user_id = ? AND token = ?", (user_id, token)))
+
+    async def list_quarantine(self) -> Dict[str, Dict[str, object]]:
+        rows = await self._query("SELECT user_id, token, failures, retry_at FROM quarantine")
+        return {user_id: {"token": token, "failures": failures, "retry_at": retry_at}
+                for user_id, token, failures, retry_at in rows}
+
+    async def delete_quarantine(self, user_id: str) -> None:
+        await self._write(("DELETE FROM quarantine WHERE user_id = ?", (user_id,)))
+
+    ######
+    # Now playing
+    ######
+
+    async def update_song(self, fields: Dict[str, Union[str, int]]) -> int:
+        def transaction():
+            with self._db:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO song (field, value) VALUES (?, ?)", fields.items())
+                self._db.execute(
+                    "INSERT INTO song (field, value) VALUES ('version', 1) "
+                    "ON CONFLICT (field) DO UPDATE SET value = value + 1")
+                return self._db.execute("SELECT value FROM song WHERE field = 'version'").fetchone()[0]
+        return await self._run(transaction)
+
+    async def get_song_version(self) -> int:
+        rows = await self._query("SELECT value FROM song WHERE field = 'version'")
+        return int(rows[0][0]) if rows else 0
+
+    async def get_song(self) -> Dict[str, Union[str, int]]:
+        return dict(await self._query("SELECT field, value FROM song"))
+
+    async def write_track(self, track_info: Dict[str, Union[str, int]]) -> None:
+        now = time.time()
+        expires = now + config.settings.TRACKS_TTL
+        await self._write(
+            ("DELETE FROM tracks WHERE expires < ?", (now,)),
+            ("INSERT OR REPLACE INTO tracks (track_id, info, expires) VALUES (?, ?, ?)",
+             (track_info["id"], json.dumps(track_info), expires)))
+
+    async def get_track(self, track_id: str) -> Optional[Dict[str, Union[str, int]]]:
+        rows = await self._query(
+            "SELECT info FROM tracks WHERE track_id = ? AND expires >= ?", track_id, time.time())
+        return json.loads(rows[0][0]) if rows else None
+
+    ######
+    # Profiles
+    ######
+
+    async def write_profile(self, key: str, profile: Dict[str, str], ttl: int) -> None:
+        now = time.time()
+        await self._write(
+            ("DELETE FROM profiles WHERE expires < ?", (now,)),
+            ("INSERT OR REPLACE INTO profiles (key, profile, expires) VALUES (?, ?, ?)",
+             (key, json.dumps(profile), now + ttl)))
+
+    async def get_profile(self, key: str) -> Optional[Dict[str, str]]:
+        rows = await self._query(
+            "SELECT profile FROM profiles WHERE key = ? AND expires >= ?", key, time.time())
+        return json.loads(rows[0][0]) if rows else None
+
+    ######
+    # Worker state
+    ######
+
+    async def write_state(self, state: Dict[str, object]) -> None:
+        await self._write((
+            "INSERT OR REPLACE INTO state (key, value) VALUES ('worker', ?)", (json.dumps(state),)))
+
+    async def get_state(self) -> Dict[str, object]:
+        rows = await self._query("SELECT value FROM state WHERE key = 'worker'")
+        return json.loads(rows[0][0]) if rows else {}
+
+    ######
+    # Devices
+    ######
+
+    async def write_device(self, user_id: str, device_id: str) -> None:
+        await self._write((
+            "INSERT OR REPLACE INTO devices (user_id, device_id, updated) VALUES (?, ?, ?)",
+            (user_id, device_id, time.time())))
+
+    async def get_device(self, user_id: str) -> Optional[str]:
+        rows = await self._query("SELECT device_id FROM devices WHERE user_id = ?", user_id)
+        return rows[0][0] if rows else None
+
+    ######
+    # Sessions
+    ######
+
+    async def write_session(self, session_id: str, user_id: str, ttl: int) -> None:
+        now = time.time()
+        await self._write(
+            ("DELETE FROM sessions WHERE expires < ?", (now,)),
+            ("INSERT OR REPLACE INTO sessions (session_id, user_id, expires) VALUES (?, ?, ?)",
+             (session_id, user_id, now + ttl)))
+
+    async def get_session(self, session_id: str) -> Optional[str]:
+        rows = await self._query(
+            "SELECT user_id FROM sessions WHERE session_id = ? AND expires >= ?", session_id, time.time())
+        return rows[0][0] if rows else None
+
+    async def pop_session(self, session_id: str) -> Optional[str]:
+        def transaction():
+            with self._db:
+                row = self._db.execute(
+                    "SELECT user_id FROM sessions WHERE session_id = ? AND expires >= ?",
+                    (session_id, time.time())).fetchone()
+                self._db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+            return row[0] if row else None
+        return await self._run(transaction)
+
+    async def delete_sessions(self, user_id: str) -> None:
+        await self._write(("DELETE FROM sessions WHERE user_id = ?", (user_id,)))
+
+    async def write_ban(self, user_id: str, ttl: int) -> None:
+        now = time.time()
+        await self._write(
+            ("DELETE FROM bans WHERE expires < ?", (now,)),
+            ("INSERT OR REPLACE INTO bans (user_id, expires) VALUES (?, ?)", (user_id, now + ttl)))
+
+    async def is_banned(self, user_id: str) -> bool:
+        return bool(await self._query(
+            "SELECT 1 FROM bans WHERE user_id = ? AND expires >= ?", user_id, time.time()))
+
+    ######
+    # Presence
+    ######
+
+    async def write_presence(self, user_id: str, ttl: int) -> None:
+        now = time.time()
+        await self._write(
+            ("DELETE FROM presence WHERE expires < ?", (now,)),
+            ("INSERT OR REPLACE INTO presence (user_id, expires) VALUES (?, ?)",
+             (user_id, now + ttl)))
+
+    async def delete_presence(self, user_id: str) -> None:
+        await self._write(("DELETE FROM presence WHERE user_id = ?", (user_id,)))
+
+    async def list_present(self) -> List[str]:
+        return [row[0] for row in await self._query(
+            "SELECT user_id FROM presence WHERE expires >= ?", time.time())]
+
+    ######
+    # API budget
+    ######
+
+    async def spend_budget(self, bucket: int, amount: int, ttl: int) -> Tuple[int, int]:
+        def transaction():
+            with self._db:
+                self._db.execute("DELETE FROM budget WHERE bucket < ?", (bucket - 1,))
+                self._db.execute(
+                    "INSERT INTO budget (bucket, count) VALUES (?, ?) "
+                    "ON CONFLICT (bucket) DO UPDATE SET count = count + excluded.count",
+                    (bucket, amount))
+                counts = dict(self._db.execute(
+                    "SELECT bucket, count FROM budget WHERE bucket >= ?", (bucket - 1,)))
+            return counts.get(bucket - 1, 0), counts[bucket]
+        return await self._run(transaction)
+
+    ######
+    # Event log
+    ######
+
+    async def append_events(self, events: List[Dict[str, object]], max_len: int) -> None:
+        await self._write(
+            *[("INSERT INTO events (event) VALUES (?)", (json.dumps(event),)) for event in events],
+            ("DELETE FROM events WHERE id <= (SELECT MAX(id) FROM events) - ?", (max_len,)))
+
+    async def read_events(self, after: Optional[str], count: int,
+                          wait: float) -> List[Tuple[str, Dict[str, object]]]:
+        if after is None:
+            rows = reversed(await self._query(
+                "SELECT id, event FROM events ORDER BY id DESC LIMIT ?", count))
+        else:
+            deadline = time.monotonic() + wait
+            while True:
+                rows = await self._query(
+                    "SELECT id, event FROM events WHERE id > ? ORDER BY id LIMIT ?",
+                    int(after.partition("-")[0]), count)
+                if rows or time.monotonic() >= deadline:
+                    break
+                await asyncio.sleep(0.5)
+        return [(str(event_id), json.loads(event)) for event_id, event in rows]
+
+    ######
+    # Follower status
+    ######
+
+    async def write_statuses(self, statuses: Dict[str, Dict[str, object]]) -> None:
+        await self._write(*[
+            ("INSERT OR REPLACE INTO statuses (user_id, status) VALUES (?, ?)",
+             (user_id, json.dumps(status))) for user_id, status in statuses.items()])
+
+    async def get_statuses(self, user_ids: List[str]) -> Dict[str, Dict[str, object]]:
+        if not user_ids:
+            return {}
+        rows = await self._query(
+            "SELECT user_id, status FROM statuses WHERE user_id IN (%s)"
+            % ",".join("?" * len(user_ids)), *user_ids)
+        return {user_id: json.loads(status) for user_id, status in rows}
+
+    ######
+    # Commands
+    ######
+
+    async def push_commands(self, commands: List[Dict[str, object]]) -> None:
+        await self._write(*[("INSERT INTO commands (command) VALUES (?)", (json.dumps(command),))
+                            for command in commands])
+
+    async def pop_commands(self) -> List[Dict[str, object]]:
+        def transaction():
+            with self._db:
+                rows = self._db.execute("SELECT id, command FROM commands ORDER BY id").fetchall()
+                if rows:
+                    self._db.execute("DELETE FROM commands WHERE id <= ?", (rows[-1][0],))
+            return [json.loads(command) for _, command in rows]
+        return await self._run(transaction)
@@ -0,0 +1,166 @@
+"""
+Background sweeper for stale follower tokens.
+
+Followers whose tokens stop working would otherwise stay in the store, and
+every later sync would spend an OAuth call trying to refresh them again. The
+sweeper walks the stored tokens a small batch at a time and tries each one it
+isn't already sure of. Syncs report their failures here too.
+
+Tokens Spotify rejects outright (revoked access, expired grant) are deleted.
+Tokens that keep failing for other reasons are moved out of the live set into
+quarantine, and retried on a growing backoff until they work again (and go
+back in) or fail too many times (and are dropped).
+
+Config:
+    SWEEPER_INTERVAL: Seconds between batches. Default 60.
+    SWEEPER_BATCH: Tokens checked per batch. Default 10.
+    SWEEPER_MAX_FAILURES: Failures in a row before a token is quarantined. Default 3.
+    SWEEPER_BACKOFF: Seconds until a quarantined token's first retry. Doubles each retry. Default 300.
+    SWEEPER_GIVE_UP: Failures after which a quarantined token is dropped. Default 10.
+"""
+import asyncio
+import logging
+import time
+
+from typing import Callable, Dict, Optional
+
+from utils import config
+from utils.budget import Budget
+from utils.spotify import Spotify
+
+
+class TokenSweeper:
+    def __init__(self, store, spotify: Spotify, is_live: Callable[[str], bool] = lambda user_id: False,
+                 events=None):
+        """Set up the sweeper.
+
+        Parameters
+        ----------
+        store: Store
+            Store the tokens live in.
+        spotify: Spotify
+            Used to test tokens.
+        is_live: callable
+            is_live(user_id) is True for followers with a working client, which needn't be checked.
+        events: EventLog or None
+            Where to record deleted and quarantined tokens.
+        """
+        self.store = store
+        self.spotify = spotify
+        self.is_live = is_live
+        self.events = events
+        self.failures: Dict[str, int] = {}
+        self._cursor = ""
+        self._task = None
+
+    def start(self) -> None:
+        """Start sweeping in the background."""
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(config.settings.SWEEPER_INTERVAL)
+            try:
+                await self.sweep()
+                await self.retry_quarantine()
+            except Budget.Exhausted:
+                pass
+            except Exception:
+                logging.exception("Token sweep failed")
+
+    def _emit(self, kind: str, **fields) -> None:
+        if self.events is not None:
+            self.events.emit(kind, **fields)
+
+    async def sweep(self) -> None:
+        """Check the next batch of stored tokens."""
+        cursor, user_ids = await self.store.scan_tokens(self._cursor, config.settings.SWEEPER_BATCH)
+        self._cursor = cursor or ""
+        user_ids = [u for u in user_ids if u != "main" and not self.is_live(u)]
+        tokens = await self.store.get_tokens(user_ids)
+        for user_id, token_str in tokens.items():
+            try:
+                token = await self.spotify.refresh_token(token_str)
+            except Spotify.BadToken as err:
+                await self.failed(user_id, token_str, err)
+            else:
+                self.failures.pop(user_id, None)
+                if token.refresh_token != token_str:
+                    await self.store.write_token(user_id, token.refresh_token)
+
+    async def failed(self, user_id: str, token_str: Optional[str], err: Exception) -> None:
+        """Note that a follower's token didn't work.
+
+        Deletes the token if Spotify rejected it outright, or quarantines it once
+        it's failed SWEEPER_MAX_FAILURES times in a row. Only Spotify.BadToken
+        counts: errors from the network, the store or anything else aren't the
+        token's fault. Store errors here are logged rather than raised, so a
+        failing follower can't take down the caller.
+
+        Parameters
+        ----------
+        user_id: str
+            Follower whose token failed.
+        token_str: str or None
+            The token that failed, if known.
+        err: Exception
+            What went wrong.
+        """
+        if token_str is None or user_id == "main" or not isinstance(err, Spotify.BadToken):
+            return
+        try:
+            await self._failed(user_id, token_str, err)
+        except Exception:
+            logging.exception("Couldn't record token failure for %s", user_id)
+
+    async def _failed(self, user_id: str, token_str: str, err: Exception) -> None:
+        if isinstance(err, Spotify.RevokedToken):
+            logging.info("Deleting revoked token for %s", user_id)
+            self.failures.pop(user_id, None)
+            await asyncio.gather(self.store.delete_token(user_id),
+                                 self.store.delete_presence(user_id))
+            self._emit("revoked", user=user_id)
+            return
+        failures = self.failures.get(user_id, 0) + 1
+        settings = config.settings
+        if failures < settings.SWEEPER_MAX_FAILURES:
+            self.failures[user_id] = failures
+            return
+        self.failures.pop(user_id, None)
+        logging.info("Quarantining token for %s after %d failures", user_id, failures)
+        await self.store.quarantine_token(
+            user_id, token_str, failures, time.time() + settings.SWEEPER_BACKOFF)
+        self._emit("quarantine", user=user_id, failures=failures)
+
+    async def retry_quarantine(self) -> None:
+        """Retry quarantined tokens that are due, up to a batch of them."""
+        settings = config.settings
+        now = time.time()
+        quarantine = await self.store.list_quarantine()
+        due = sorted((entry["retry_at"], user_id) for user_id, entry in quarantine.items()
+                     if entry["retry_at"] <= now)
+        for _, user_id in due[:settings.SWEEPER_BATCH]:
+            entry = quarantine[user_id]
+            if await self.store.have_token(user_id):
+                # They've logged in again since.
+                await self.store.delete_quarantine(user_id)
+                continue
+            try:
+                token = await self.spotify.refresh_token(entry["token"])
+            except Spotify.RevokedToken:
+                logging.info("Dropping revoked quarantined token for %s", user_id)
+                await self.store.delete_quarantine(user_id)
+                self._emit("revoked", user=user_id)
+            except Spotify.BadToken:
+                failures = entry["failures"] + 1
+                if failures >= settings.SWEEPER_GIVE_UP:
+                    logging.info("Giving up on quarantined token for %s", user_id)
+                    await self.store.delete_quarantine(user_id)
+                    continue
+                backoff = settings.SWEEPER_BACKOFF * 2 ** (failures - settings.SWEEPER_MAX_FAILURES)
+                await self.store.quarantine_token(user_id, entry["token"], failures, now + backoff)
+            else:
+                logging.info("Restoring quarantined token for %s", user_id)
+                await self.store.write_token(user_id, token.refresh_token)
+                await self.store.delete_quarantine(user_id)
+                self._emit("restored", user=user_id)
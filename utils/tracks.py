@@ -0,0 +1,143 @@
+"""
+Track metadata cache.
+
+We only ever render a handful of fields for a track (name, artists, album art,
+duration), so rather than storing or refetching tekore's full model, tracks are
+flattened to a small dict and kept in a bounded in-process LRU. If the store
+supports it, the store is used as a shared second tier so the web server can
+reuse what the worker has already seen (and vice versa).
+
+Flattened tracks look like:
+    {"id": "4uLU6hMCjMI75M1A2tKUQC", "name": "Never Gonna Give You Up",
+     "artists": "Rick Astley", "art": "https://i.scdn.co/image/...",
+     "art_large": "https://i.scdn.co/image/...", "duration_ms": 213573}
+"""
+import collections
+import logging
+
+from typing import Dict, Optional
+
+import tekore as tk
+
+from utils import config
+
+
+def flatten(item) -> Dict[str, object]:
+    """Flatten a tekore track (or episode) into the fields we render.
+
+    Parameters
+    ----------
+    item: tk.model.FullTrack or tk.model.FullEpisode
+        Item from a CurrentlyPlaying object or a track lookup.
+
+    Returns
+    -------
+    {str: str or int}: Flattened track info. See the module docstring.
+    """
+    if getattr(item, "artists", None) is not None:
+        artists = ", ".join(artist.name for artist in item.artists)
+        images = item.album.images
+    else:
+        # Podcast episodes have a show instead of artists and an album.
+        artists = item.show.name if getattr(item, "show", None) else ""
+        images = item.images or []
+    # Spotify sorts images widest first.
+    return {
+        "id": item.id,
+        "name": item.name,
+        "artists": artists,
+        "art": images[-1].url if images else "",
+        "art_large": images[0].url if images else "",
+        "duration_ms": item.duration_ms,
+    }
+
+
+class TrackCache:
+    def __init__(self, store=None, size: Optional[int] = None):
+        """Set up the cache.
+
+        Parameters
+        ----------
+        store: Store or None
+            Store to use as a shared second tier.
+        size: int or None
+            Max number of tracks held in process. Defaults to TRACKS_CACHE_SIZE, or 512.
+        """
+        self.store = store
+        self.size = size or config.settings.TRACKS_CACHE_SIZE
+        self._tracks = collections.OrderedDict()
+
+    def _remember(self, info: Dict[str, object]) -> None:
+        self._tracks[info["id"]] = info
+        self._tracks.move_to_end(info["id"])
+        while len(self._tracks) > self.size:
+            self._tracks.popitem(last=False)
+
+    async def get(self, track_id: str) -> Optional[Dict[str, object]]:
+        """Get flattened info for a track, if we have it cached anywhere.
+
+        Parameters
+        ----------
+        track_id: str
+            Spotify ID of the track.
+
+        Returns
+        -------
+        dict or None: Flattened track info, or None on a miss.
+        """
+        info = self._tracks.get(track_id)
+        if info is not None:
+            self._tracks.move_to_end(track_id)
+            return info
+        if self.store is None:
+            return None
+        try:
+            info = await self.store.get_track(track_id)
+        except Exception:
+            logging.exception("Could not read track %s from store", track_id)
+            return None
+        if info is not None:
+            self._remember(info)
+        return info
+
+    async def put(self, item) -> Dict[str, object]:
+        """Cache a tekore track. Writes through to the store on a local miss.
+
+        Parameters
+        ----------
+        item: tk.model.FullTrack or tk.model.FullEpisode
+            Track to cache.
+
+        Returns
+        -------
+        dict: The flattened track info.
+        """
+        if item.id in self._tracks:
+            return await self.get(item.id)
+        info = flatten(item)
+        self._remember(info)
+        if self.store is not None:
+            try:
+                await self.store.write_track(info)
+            except Exception:
+                logging.exception("Could not write track %s to store", item.id)
+        return info
+
+    async def fetch(self, track_id: str, client: tk.Spotify) -> Dict[str, object]:
+        """Get flattened info for a track, asking Spotify on a cache miss.
+
+        Parameters
+        ----------
+        track_id: str
+            Spotify ID of the track.
+        client: tk.Spotify
+            Client to use on a miss.
+
+        Returns
+        -------
+        dict: Flattened track info.
+        """
+        info = await self.get(track_id)
+        if info is None:
+            info = await self.put(await client.track(track_id))
+        return info
@@ -6,19 +6,92 @@ and attempts to have followers play everything the main user does.
 import argparse
 import asyncio
 import logging
+import math
+import signal
+import time
 
-from typing import Dict, Tuple, Optional
+from typing import Dict, List, Set, Tuple, Optional
 
 import tekore as tk
 
-from utils import config
+from utils import config, logs
+from utils.events import EventLog
+from utils.nowplaying import NowPlaying
 from utils.spotify import Spotify
-from utils.store import get_store
+from utils.store import new_store
+from utils.sweeper import TokenSweeper
+from utils.tracks import TrackCache
+
+
+# How close to the end of a track the leader has to have been, and how close to
+# the start of the next, for a track change to count as the context advancing
+# on its own. Two ticks, plus some slack for API latency.
+AdvanceWindowMs = 5000
 
 
 class FatalError(Exception):
     pass
 
+
+def followable_context(now_playing: Optional[tk.model.CurrentlyPlayingContext]) -> Optional[str]:
+    """Get the URI of the context the leader is playing, if followers can play it too.
+
+    Followers can only track the leader through a context if it's a playlist or
+    album (which accept a track offset), and shuffle is off (otherwise each
+    player picks its own next track).
+
+    Parameters
+    ----------
+    now_playing: tk.model.CurrentlyPlayingContext or None
+        The leader's current playback.
+
+    Returns
+    -------
+    str or None: The context URI, or None if followers need tracks one at a time.
+    """
+    if not now_playing or not now_playing.context or now_playing.shuffle_state:
+        return None
+    uri = now_playing.context.uri
+    if ":playlist:" in uri or uri.startswith("spotify:album:"):
+        return uri
+    return None
+
+def merge_commands(commands: List[Dict[str, object]]) -> Dict[str, object]:
+    """Collapse a tick's worth of queued commands into what actually needs doing.
+
+    Repeats are merged: any number of skips is one skip, the last pause or resume
+    and the last volume win, and resyncs are pooled (a resync of everyone covers
+    the rest).
+
+    Parameters
+    ----------
+    commands: [{str: object}]
+        Commands in the order they were queued, e.g. {"kind": "volume", "level": 50}.
+
+    Returns
+    -------
+    {str: object}: Any of "skip" (True), "playing" (bool), "volume" (int) and
+        "resync" (a set of user IDs, or None for everyone).
+    """
+    merged = {}
+    for command in commands:
+        kind = command.get("kind")
+        if kind == "skip":
+            merged["skip"] = True
+        elif kind in ("pause", "resume"):
+            merged["playing"] = kind == "resume"
+        elif kind == "volume":
+            merged["volume"] = max(0, min(100, int(command.get("level", 100))))
+        elif kind == "resync":
+            if command.get("all") or merged.get("resync", set()) is None:
+                merged["resync"] = None
+            else:
+                merged.setdefault("resync", set()).update(command.get("users", []))
+        else:
+            logging.warning("Ignoring unknown command %s", kind)
+    return merged
+
+
 #######
 # SYNC OPERATIONS
 #######
@@ -28,11 +101,50 @@ class Worker:
     def __init__(self, store, spotify):
         self.store = store
         self.spotify = spotify
+        self.tracks = TrackCache(store)
+        self.events = EventLog(store)
+        self.now_playing = NowPlaying(store)
+        self.sweeper = TokenSweeper(store, spotify, is_live=lambda user_id: user_id in self.followers,
+                                    events=self.events)
+        self.concurrency = config.settings.WORKER_CONCURRENCY
+        self.limit = asyncio.Semaphore(self.concurrency)
+        # Sync state. Checkpointed to the store after every change.
+        self.leader = None
+        self.followers = dict()
+        self.song_id, self.playing = None, False
+        # Context followers were last started on, and the leader's playback as of the last check.
+        self.context = None
+        self.last_seen = None
+        self.last_seen_at = 0.0
+        # Per-follower sync outcomes waiting to be written for the admin page.
+        self.statuses = dict()
+        # Background follower set-up (after a restore, ahead of a track boundary, or
+        # for late joiners). Finished before a sync touches the followers.
+        self.warming = None
+        # (song_id, time.monotonic()) of the last pre-warm to finish.
+        self.prewarmed = (None, 0.0)
+        # The last fan-out, if followers are still starting after the leader resumed,
+        # and those followers' plays.
+        self.catching_up = None
+        self.stragglers = set()
+
+    def reconfigure(self, settings) -> None:
+        """Apply reloaded settings. Calls already in flight finish under the old limit."""
+        if settings.WORKER_CONCURRENCY != self.concurrency:
+            self.concurrency = settings.WORKER_CONCURRENCY
+            self.limit = asyncio.Semaphore(self.concurrency)
+
+    async def bounded(self, coro):
+        """Await a coroutine, limited to WORKER_CONCURRENCY at a time across the worker."""
+        async with self.limit:
+            return await coro
 
     async def check_new(self, leader: tk.Spotify, current_id: Optional[str], current_playing: bool) -> Tuple[bool, str, bool]:
         """Check if the leader is playing a different track than the provided ID.
 
-        This method also writes out new song information using the store.
+        This method also stages changes to the now-playing record (written once
+        per tick by the run loop), caches the new track's metadata, and keeps the
+        full playback state in last_seen.
         If spotify throws an error (perish the thought), pretend nothing changed,
         we'll grab it again next time.
 
@@ -55,21 +167,46 @@ class Worker:
         except:
             logging.exception("Error getting currently playing track.")
             return False, current_id, current_playing
+        self.last_seen = new
+        self.last_seen_at = time.monotonic()
         new_id = new.item.id if new and new.item else None
         new_playing = new.is_playing if new and new.item else False
         changed = (new_id != current_id or new_playing != current_playing)
-        if changed:
-            new_track = new.item.name if new and new.item else "Not Playing"
-            logging.info(f"New track: {new_track}")
-            await self.store.write_song(new.item.json() if new else "null")
+        if new_id != current_id:
+            if new_id:
+                track = await self.tracks.put(new.item)
+                logging.info("New track: %s", track["name"])
+            else:
+                logging.info("New track: Not Playing")
+        self.now_playing.set(track_id=new_id or "", playing=int(new_playing),
+                             device=new.device.name if new and new.device else "")
         return changed, new_id, new_playing
 
-    async def sync(self, leader: tk.Spotify, followers: Dict[str, tk.Spotify], song_id: Optional[str], playing: bool) -> None:
+    def resumed_in_place(self, previous: Optional[tk.model.CurrentlyPlayingContext],
+                         previous_id: Optional[str]) -> bool:
+        """Check if the leader has just resumed the track it was paused on.
+
+        Parameters
+        ----------
+        previous: tk.model.CurrentlyPlayingContext or None
+            The leader's playback before the change.
+        previous_id: str or None
+            The track ID before the change.
+
+        Returns
+        -------
+        bool: True if followers can be started at the leader's position instead of a fan-out.
+        """
+        return (self.playing and self.song_id is not None and self.song_id == previous_id
+                and previous is not None and previous.item is not None and not previous.is_playing)
+
+    async def sync(self, leader: tk.Spotify, followers: Dict[str, tk.Spotify], song_id: Optional[str], playing: bool,
+                   context_uri: Optional[str] = None) -> None:
         """Sync the list of followers to the leader
 
         If given a song_id and playing is True, will attempt to sync all followers
-        to that song. If given a song_id of None or playing is False, will attempt
-        to stop all followers.
+        to that song (within the given context, if any). If given a song_id of None
+        or playing is False, will attempt to stop all followers.
 
         Parameters
         ----------
@@ -81,20 +218,60 @@ class Worker:
             The song ID to sync, or None if the followers should be stopped.
         playing: bool
             Whether the leader is currently playing.
+        context_uri: str or None
+            Context to start followers on, from followable_context.
         """
+        # Whatever happens next, stragglers from the last fan-out shouldn't start playing.
+        self.cancel_catch_up()
         if song_id == None or playing == False:
             logging.info("leader stopped.")
             await self.stop_all(followers)
         else:
-            logging.info(f"Got new track: {song_id}")
-            await self.play_to_all(song_id, leader, followers)
+            logging.info("Got new track: %s", song_id)
+            await self.play_to_all(song_id, leader, followers, context_uri)
+
+    def advanced_with_context(self, previous: Optional[tk.model.CurrentlyPlayingContext],
+                              current: Optional[tk.model.CurrentlyPlayingContext]) -> bool:
+        """Check if followers will have moved on to the leader's new track by themselves.
 
-    async def play_to_all(self, track_id: str, leader: tk.Spotify, followers: Dict[str, tk.Spotify]) -> None:
+        That's the case when followers were started on the leader's context and the
+        leader got to the new track by finishing the last one, rather than skipping.
+
+        Parameters
+        ----------
+        previous: tk.model.CurrentlyPlayingContext or None
+            The leader's playback before the change.
+        current: tk.model.CurrentlyPlayingContext or None
+            The leader's playback now.
+
+        Returns
+        -------
+        bool: True if no fan-out is needed.
+        """
+        if not (previous and current and previous.item and current.item):
+            return False
+        if not (previous.is_playing and current.is_playing):
+            return False
+        context = followable_context(current)
+        if context is None or context != self.context or context != followable_context(previous):
+            return False
+        remaining = previous.item.duration_ms - (previous.progress_ms or 0)
+        return remaining <= AdvanceWindowMs and (current.progress_ms or 0) <= AdvanceWindowMs
+
+    async def play_to_all(self, track_id: str, leader: tk.Spotify, followers: Dict[str, tk.Spotify],
+                          context_uri: Optional[str] = None) -> None:
         """Synchronize playback of a given track to all followers and the leader.
 
-        This attempts to stop the leader and start playback again once all clients are playing.
-        It means the leader will necessarily lag the followers a tiny bit. It also means we
-        can only sync a song from the beginning, not the middle.
+        This attempts to stop the leader and start playback again once enough clients are playing:
+        WORKER_QUORUM of them, or however many have started by WORKER_QUORUM_DEADLINE seconds,
+        whichever comes first. It means the leader will necessarily lag the followers a tiny bit.
+        It also means we can only sync a song from the beginning, not the middle.
+
+        Followers still starting when the leader resumes are left to finish in the
+        background (see catch_up), so one slow client can't hold up the room.
+
+        If given a context, followers play the track within it and will advance
+        along with the leader without another fan-out.
 
         Parameters
         ----------
@@ -104,22 +281,243 @@ class Worker:
             Leader spotify client
         followers: {str: tk.Spotify}
             Dictionary of user_id -> spotify client for each follower.
+        context_uri: str or None
+            Context to play the track in, or None to play it alone.
         """
         try:
             await leader.playback_pause()
             await leader.playback_seek(0)
         except:
             pass
-        results = await asyncio.gather(*[
-            self.spotify.play_track(user, client, track_id) for (user, client) in followers.items()
-        ])
+        # Until enough followers are actually on the context, they can't be left to advance with it.
+        self.context = None
+        settings = config.settings
+        start = time.monotonic()
+        done, pending = set(), {
+            asyncio.ensure_future(self.bounded(self.play(user, client, track_id, context_uri=context_uri)))
+            for (user, client) in followers.items()}
+        quorum = math.ceil(len(pending) * settings.WORKER_QUORUM)
+        deadline = start + settings.WORKER_QUORUM_DEADLINE
+        while pending and len(done) < quorum and time.monotonic() < deadline:
+            finished, pending = await asyncio.wait(
+                pending, timeout=deadline - time.monotonic(), return_when=asyncio.FIRST_COMPLETED)
+            done |= finished
+        started = sum(1 for play in done if play.result()[1])
+        if context_uri and started >= quorum:
+            self.context = context_uri
         try:
             await leader.playback_resume()
         except:
             logging.exception("Couldn't make user continue. Oh well.")
-        for user, success in results:
-            if not success:
-                logging.info(f"couldn't play track for {user}")
+        resumed = time.monotonic()
+        held_ms = round((resumed - start) * 1000)
+        logging.info("Leader held %dms: %d of %d followers started, %d still starting",
+                     held_ms, len(done), len(followers), len(pending))
+        self.stragglers = pending
+        self.catching_up = asyncio.create_task(self.catch_up(
+            done, pending, followers, start, resumed,
+            dict(track=track_id, context=context_uri or "", held_ms=held_ms)))
+
+    def cancel_catch_up(self) -> None:
+        """Abandon followers still starting from the last fan-out."""
+        if self.catching_up is not None and not self.catching_up.done():
+            self.catching_up.cancel()
+        # Cancel the plays too: a catch_up cancelled before it first ran never gets to.
+        for play in self.stragglers:
+            play.cancel()
+        self.catching_up = None
+        self.stragglers = set()
+
+    async def catch_up(self, done: Set[asyncio.Future], pending: Set[asyncio.Future],
+                       followers: Dict[str, tk.Spotify], start: float, resumed: float,
+                       fanout: Dict[str, object]) -> None:
+        """Finish a fan-out in the background once the leader has resumed.
+
+        Followers that start after the leader resumed are behind it, so each one is
+        sought forward to where the leader has got to. Then the fan-out's "fanout"
+        event is recorded and follower statuses written.
+
+        Parameters
+        ----------
+        done: {asyncio.Future}
+            Plays that finished before the leader resumed.
+        pending: {asyncio.Future}
+            Plays still in flight.
+        followers: {str: tk.Spotify}
+            Dictionary of user_id -> spotify client for each follower in the fan-out.
+        start: float
+            time.monotonic() when the fan-out began.
+        resumed: float
+            time.monotonic() when the leader resumed from the top of the track.
+        fanout: {str: object}
+            Extra details for the fan-out event: track, context and held_ms.
+        """
+        async def finish(play):
+            user, success = await play
+            if success:
+                try:
+                    await followers[user].playback_seek(round((time.monotonic() - resumed) * 1000))
+                except Exception:
+                    logging.exception("Couldn't catch %s up to the leader", user)
+            return user, success
+        try:
+            results = [play.result() for play in done]
+            results += await asyncio.gather(*[finish(play) for play in pending])
+        except asyncio.CancelledError:
+            for play in pending:
+                play.cancel()
+            raise
+        failed = [user for user, success in results if not success]
+        for user in failed:
+            logging.info("couldn't play track for %s", user)
+        self.events.emit("fanout", followers=len(followers), failed=",".join(failed),
+                         stragglers=len(pending), ms=round((time.monotonic() - start) * 1000), **fanout)
+        logging.info("API budget: %.0f/%d requests", self.spotify.budget.used, self.spotify.budget.limit)
+        await self.flush_statuses()
+
+    def leader_position_ms(self, now: float) -> int:
+        """Estimate where the leader is in its track.
+
+        last_seen.progress_ms is as of the last check, up to WORKER_INTERVAL ago. While
+        the leader is playing, the time since is added on, so followers started
+        late in a tick don't land behind. It's capped just short of the track's end,
+        since starting past it would skip followers on to the next track.
+
+        Parameters
+        ----------
+        now: float
+            time.monotonic() to estimate the position at.
+
+        Returns
+        -------
+        int: Position in milliseconds.
+        """
+        position_ms = self.last_seen.progress_ms or 0
+        if self.playing:
+            position_ms += round((now - self.last_seen_at) * 1000)
+        return max(0, min(position_ms, self.last_seen.item.duration_ms - 1000))
+
+    async def start_followers(self, followers: Dict[str, tk.Spotify]) -> None:
+        """Start followers on the leader's current track and position, without pausing the leader.
+
+        Used to bring in followers that joined while the room was advancing on its own.
+        Records a "fanout" event like play_to_all, if there was anyone to start.
+
+        Parameters
+        ----------
+        followers: {str: tk.Spotify}
+            Dictionary of user_id -> spotify client for each follower to start.
+        """
+        if not followers or not self.last_seen or not self.last_seen.item:
+            return
+        start = time.monotonic()
+        position_ms = self.leader_position_ms(start)
+        results = await asyncio.gather(*[
+            self.bounded(self.play(
+                user, client, self.song_id, context_uri=self.context, position_ms=position_ms))
+            for user, client in followers.items()])
+        self.events.emit("fanout", track=self.song_id, context=self.context or "",
+                         followers=len(followers),
+                         failed=",".join(user for user, success in results if not success),
+                         ms=round((time.monotonic() - start) * 1000))
+
+    async def play(self, user: str, client: tk.Spotify, track_id: str, **kwargs) -> Tuple[str, bool]:
+        """Play a track for one follower, and note how it went for the admin page.
+
+        Takes the same arguments as Spotify.play_track, and likewise never raises.
+        """
+        start = time.monotonic()
+        user, success = await self.spotify.play_track(user, client, track_id, **kwargs)
+        self.statuses[user] = {"ok": int(success), "ms": round((time.monotonic() - start) * 1000),
+                               "ts": round(time.time())}
+        return user, success
+
+    async def flush_statuses(self) -> None:
+        """Write any new follower sync outcomes to the store."""
+        statuses, self.statuses = self.statuses, dict()
+        if not statuses:
+            return
+        try:
+            await self.store.write_statuses(statuses)
+        except Exception:
+            logging.exception("Could not write follower statuses")
+
+    async def run_commands(self) -> None:
+        """Carry out commands the web server has queued for us.
+
+        Commands queued since the last tick are merged first (see merge_commands):
+            {"kind": "skip"}: Skip the leader to the next track.
+            {"kind": "pause"} / {"kind": "resume"}: Pause or resume the leader.
+            {"kind": "volume", "level": 0-100}: Set everyone's volume.
+            {"kind": "resync", "users": [...]} or {"kind": "resync", "all": true}:
+                Restart followers at the leader's current position.
+
+        Skips, pauses and resumes only act on the leader; followers catch up later in
+        the same tick, through the usual fan-out or, for a resume, by being started at
+        the leader's position.
+        """
+        try:
+            commands = await self.store.pop_commands()
+        except Exception:
+            logging.exception("Could not read commands")
+            return
+        if not commands:
+            return
+        merged = merge_commands(commands)
+        logging.info("Running %d commands as %s", len(commands), ", ".join(sorted(merged)) or "nothing")
+        self.events.emit("commands", queued=len(commands), run=",".join(sorted(merged)))
+        if "volume" in merged:
+            await self.set_volume(merged["volume"])
+        try:
+            if merged.get("skip"):
+                await self.leader.playback_next()
+            if merged.get("playing") is False:
+                await self.leader.playback_pause()
+            elif merged.get("playing"):
+                await self.leader.playback_resume()
+        except Exception:
+            logging.exception("Couldn't control the leader")
+        if "resync" in merged:
+            await self.resync(set(self.followers) if merged["resync"] is None else merged["resync"])
+
+    async def set_volume(self, level: int) -> None:
+        """Set the volume of the leader and every follower.
+
+        Parameters
+        ----------
+        level: int
+            Volume percentage, 0-100.
+        """
+        async def set_one(client):
+            try:
+                await client.playback_volume(level)
+            except Exception:
+                logging.exception("Couldn't set volume")
+        logging.info("Setting volume to %d%%", level)
+        await asyncio.gather(*[self.bounded(set_one(client))
+                               for client in [self.leader, *self.followers.values()]])
+
+    async def resync(self, user_ids: Set[str]) -> None:
+        """Restart the given followers at the leader's current track and position.
+
+        Parameters
+        ----------
+        user_ids: {str}
+            IDs of followers to restart. Followers we don't have a client for yet are set up first.
+        """
+        if not self.playing or not self.song_id:
+            return
+        logging.info("Resyncing %d followers", len(user_ids))
+        missing = [user_id for user_id in user_ids if user_id not in self.followers]
+        tokens = await self.store.get_tokens(missing)
+        for user_id, client in await asyncio.gather(*[
+                self.bounded(self.setup_follower(user_id, None, token_str))
+                for user_id, token_str in tokens.items()]):
+            if client is not None:
+                self.followers[user_id] = client
+        await self.start_followers({user_id: client for user_id, client in self.followers.items()
+                                    if user_id in user_ids})
+        await self.flush_statuses()
 
     async def stop_all(self, followers: Dict[str, tk.Spotify]):
         """Stop all followers.
@@ -129,21 +527,23 @@ class Worker:
             Dictionary of user_id -> spotify client for each follower.
         """
         await asyncio.gather(*[
-            self.spotify.stop(client) for client in followers.values()
+            self.bounded(self.spotify.stop(client)) for client in followers.values()
         ])
 
     #######
     # Leader and Follower Setup
     #######
 
-    async def setup_follower(self, user_id: str, client: Optional[tk.Spotify]) -> Tuple[str, Optional[tk.Spotify]]:
+    async def setup_follower(self, user_id: str, client: Optional[tk.Spotify], token_str: Optional[str] = None,
+                             margin: float = 0) -> Tuple[str, Optional[tk.Spotify]]:
         """Check if a follower is correctly set up.
 
         This is used to verify that followers have up to date tokens and should
         still be used in the follower rotation. If we don't have a token in the
         store for a given user, we return None. If a client is provided and its
         token matches the one in the store, it is returned as-is. If not, we attempt
-        to build a client for the user.
+        to build a client for the user, and move their playback to the device we
+        last used for them. Failures are reported to the token sweeper.
 
         Parameters
         ----------
@@ -151,6 +551,10 @@ class Worker:
             ID of the user to setup and verify tokens.
         client: tk.Spotify or None
             An existing client to compare to the token on disk
+        token_str: str or None
+            The user's token, if already read from the store.
+        margin: float
+            Seconds an existing client's access token must stay valid for to be kept.
 
         Returns
         -------
@@ -158,39 +562,50 @@ class Worker:
             successfully created one.
         """
         try:
-            token_str = await self.store.get_token(user_id)
-            if self.spotify.client_is_good(client, token_str):
+            if token_str is None:
+                token_str = await self.store.get_token(user_id)
+            if self.spotify.client_is_good(client, token_str, margin):
                 return user_id, client
-            display_name, client = await self.spotify.get_user(token_str)
-            await self.spotify.set_device(client)
+            (display_name, client), device_id = await asyncio.gather(
+                self.spotify.get_user(token_str), self.store.get_device(user_id))
+            new_device_id = await self.spotify.set_device(client, device_id=device_id)
+            if new_device_id != device_id:
+                await self.store.write_device(user_id, new_device_id)
             return user_id, client
         except Exception as err:
             logging.exception("Could not set up user %s", user_id)
+            await self.sweeper.failed(user_id, token_str, err)
             return user_id, None
 
-    async def check_followers(self, followers: Dict[str, tk.Spotify]) -> Dict[str, tk.Spotify]:
+    async def check_followers(self, followers: Dict[str, tk.Spotify], margin: float = 0) -> Dict[str, tk.Spotify]:
         """Check a dictionary of followers to ensure clients and tokens are up to date.
 
         This function will ensure our followers match the set of tokens we have. Followers
-        with no tokens on file will be deleted, new tokens with no matching followers will
-        have clients created for them.
+        with no tokens on file, or whose players haven't checked in recently, will be
+        deleted. New tokens with no matching followers will have clients created for them.
 
         Parameters
         ---------
         followers: {str: tk.Spotify}
             Our existing dictionary of followers.
+        margin: float
+            Seconds existing clients' access tokens must stay valid for, or they're refreshed.
 
         Returns
         -------
-        {str: tk.Spotify}: Dictionary of followers we have tokens for.
+        {str: tk.Spotify}: Dictionary of present followers we have tokens for.
         """
-        users = [u for u in await self.store.list_tokens() if u != "main"]
+        tokens, present = await asyncio.gather(
+            self.store.list_tokens(), self.store.list_present())
+        present = set(present)
+        users = [u for u in tokens if u != "main" and u in present]
+        tokens = await self.store.get_tokens(users)
         loaded_users = await asyncio.gather(*[
-            self.setup_follower(username, followers.get(username))
-            for username in users])
+            self.bounded(self.setup_follower(username, followers.get(username), token_str, margin))
+            for username, token_str in tokens.items()])
         followers = {user: client for user,
                      client in loaded_users if client is not None}
-        logging.info(followers)
+        logging.info("%d of %d followers ready", len(followers), len(users))
         return followers
 
     async def check_leader(self, leader: Optional[tk.Spotify]) -> Optional[tk.Spotify]:
@@ -211,12 +626,150 @@ class Worker:
             token_str = await self.store.get_token("main")
             if not self.spotify.client_is_good(leader, token_str):
                 username, leader = await self.spotify.get_user(token_str)
-                logging.info(f"Got leader user: {username}")
+                logging.info("Got leader user: %s", username)
             return leader
         except Exception as err:
             logging.exception("Error getting leader user.")
             return None
 
+    #######
+    # Checkpointing
+    #######
+
+    async def checkpoint(self) -> None:
+        """Write the current sync state to the store.
+
+        Errors are logged and swallowed; a missed checkpoint only costs us an
+        extra sync after a restart.
+        """
+        try:
+            await self.store.write_state({
+                "song_id": self.song_id or "",
+                "playing": int(self.playing),
+                "followers": sorted(self.followers),
+                "context": self.context or "",
+            })
+        except Exception:
+            logging.exception("Could not checkpoint worker state")
+
+    async def restore(self) -> None:
+        """Restore sync state from the last checkpoint, if there is one.
+
+        The song and play state are restored immediately, so the first tick
+        doesn't see a change unless there really was one. Clients for the
+        checkpointed followers are set up in the background.
+        """
+        try:
+            state = await self.store.get_state()
+        except Exception:
+            logging.exception("Could not read worker checkpoint")
+            return
+        if not state:
+            return
+        self.song_id = state.get("song_id") or None
+        self.playing = bool(int(state.get("playing", 0)))
+        self.context = state.get("context") or None
+        logging.info("Restored checkpoint: song %s, %d followers",
+                     self.song_id, len(state.get("followers", [])))
+        self.warming = asyncio.create_task(
+            self.warm_followers(state.get("followers", [])))
+
+    async def warm_followers(self, user_ids: List[str]) -> None:
+        """Set up clients for the given followers concurrently.
+
+        Followers that a sync has already set up in the meantime are left alone.
+
+        Parameters
+        ----------
+        user_ids: [str]
+            IDs of the followers to set up.
+        """
+        try:
+            tokens = await self.store.get_tokens(user_ids)
+            loaded_users = await asyncio.gather(*[
+                self.bounded(self.setup_follower(user_id, None, token_str))
+                for user_id, token_str in tokens.items()])
+        except Exception:
+            # The run loop awaits this, so it mustn't raise. The next sync sets followers up.
+            logging.exception("Could not warm followers")
+            return
+        for user_id, client in loaded_users:
+            if client is not None:
+                self.followers.setdefault(user_id, client)
+        logging.info("Warmed %d of %d followers", len(self.followers), len(user_ids))
+
+    def time_left(self) -> Optional[float]:
+        """Seconds until the leader's track ends, extrapolated from the last check.
+
+        Returns
+        -------
+        float or None: None unless the leader is playing a track of known length.
+        """
+        seen = self.last_seen
+        if not (self.playing and seen and seen.item and seen.item.duration_ms):
+            return None
+        progress_ms = (seen.progress_ms or 0) + (time.monotonic() - self.last_seen_at) * 1000
+        return (seen.item.duration_ms - progress_ms) / 1000
+
+    def prewarmed_for(self, song_id: Optional[str]) -> bool:
+        """Check if followers were made ready for the end of the given track, recently enough to trust."""
+        prewarmed_id, prewarmed_at = self.prewarmed
+        lead = config.settings.WORKER_PREWARM_LEAD
+        return song_id is not None and prewarmed_id == song_id and time.monotonic() - prewarmed_at < 2 * lead
+
+    def maybe_prewarm(self) -> None:
+        """Start getting followers ready in the background if the leader's track is about to end.
+
+        Starts at most one pre-warm per track, WORKER_PREWARM_LEAD seconds ahead of the end.
+        """
+        lead = config.settings.WORKER_PREWARM_LEAD
+        left = self.time_left()
+        if left is None or left > lead or self.prewarmed_for(self.song_id):
+            return
+        if self.warming is not None and not self.warming.done():
+            return
+        self.warming = asyncio.create_task(self.prewarm(self.song_id, lead))
+
+    async def prewarm(self, song_id: str, lead: float) -> None:
+        """Set up followers ahead of a track boundary, so the switch only needs play commands.
+
+        Tokens are refreshed if they'd expire within a few leads (plus Spotify's own
+        minute of slack), so they're still good at the switch and a little after.
+
+        Parameters
+        ----------
+        song_id: str
+            Track the leader is about to finish.
+        lead: float
+            Seconds ahead of the boundary we're running.
+        """
+        start = time.monotonic()
+        before = dict(self.followers)
+        try:
+            ready = await self.check_followers(before, margin=2 * lead + 60)
+        except Exception:
+            logging.exception("Could not pre-warm followers")
+            return
+        # Keep followers a resync set up while we were busy.
+        ready.update({user: client for user, client in self.followers.items() if user not in before})
+        self.followers = ready
+        self.prewarmed = (song_id, time.monotonic())
+        logging.info("Pre-warmed %d followers in %dms", len(ready), (time.monotonic() - start) * 1000)
+
+    async def admit_joiners(self) -> None:
+        """Set up and start followers who turned up since the last pre-warm."""
+        known = set(self.followers)
+        try:
+            self.followers = await self.check_followers(self.followers)
+        except Exception:
+            logging.exception("Could not check for new followers")
+            return
+        joined = {user: client for user, client in self.followers.items() if user not in known}
+        if joined and self.playing:
+            logging.info("Starting %d followers who joined during the switch", len(joined))
+            await self.start_followers(joined)
+            await self.flush_statuses()
+
     #######
     # And now the magic.
     #######
@@ -224,30 +777,81 @@ class Worker:
     async def run(self) -> None:
         """Main sync loop
 
-        The loop runs every 2 seconds. It validates the leader user, checks if playback
-        has changed, and only if it has, updates the followers and pushes the changes.
+        The loop runs every WORKER_INTERVAL seconds (2 by default). It validates the leader user, checks if playback
+        has changed, and only if it has, updates the followers, pushes the changes,
+        and checkpoints the new state. If followers are playing the leader's context
+        and the leader simply moved on to the next track, they'll have moved on too,
+        so only followers that joined since the last sync need starting.
+
+        A few seconds before the leader's track is due to end, followers are set up
+        in the background (see prewarm), so when it does the fan-out goes straight
+        to play commands. Anyone who joined in between is brought in afterwards.
 
         It runs indefinitely, or until Spotify's API digs up another reason to throw an error
         that I haven't seen before.
         """
-        leader = None
-        followers = dict()
-        song_id, playing = None, False
+        self.events.start()
+        self.sweeper.start()
+        await asyncio.gather(self.restore(), self.now_playing.load())
+        # Tick straight away after a (re)start; the room may be mid-track.
+        delay = 0
         while True:
-            await asyncio.sleep(2)
-            leader = await self.check_leader(leader)
-            if not leader:
+            await asyncio.sleep(delay)
+            delay = config.settings.WORKER_INTERVAL
+            await self.spotify.budget.flush()
+            self.leader = await self.check_leader(self.leader)
+            if not self.leader:
                 continue
-            changed, song_id, playing = await self.check_new(leader, song_id, playing)
+            await self.run_commands()
+            previous, previous_id = self.last_seen, self.song_id
+            changed, self.song_id, self.playing = await self.check_new(
+                self.leader, self.song_id, self.playing)
             if changed:
-                followers = await self.check_followers(followers)
-                await self.sync(leader, followers, song_id, playing)
+                self.events.emit("change", track=self.song_id or "", playing=int(self.playing),
+                                 context=followable_context(self.last_seen) or "")
+                if self.warming is not None:
+                    # Don't set up the same followers twice.
+                    await self.warming
+                    self.warming = None
+                prewarmed = self.prewarmed_for(previous_id)
+                known = set(self.followers)
+                if not prewarmed:
+                    self.followers = await self.check_followers(self.followers)
+                if self.advanced_with_context(previous, self.last_seen):
+                    logging.info("Followers advanced with %s", self.context)
+                    self.events.emit("advance", track=self.song_id, context=self.context)
+                    joined = {user: client for user, client in self.followers.items()
+                              if user not in known}
+                    await self.start_followers(joined)
+                elif self.resumed_in_place(previous, previous_id):
+                    # Pick up where the leader is, rather than restarting everyone from the top.
+                    logging.info("Leader resumed %s", self.song_id)
+                    self.cancel_catch_up()
+                    await self.start_followers(self.followers)
+                else:
+                    await self.sync(self.leader, self.followers, self.song_id, self.playing,
+                                    followable_context(self.last_seen))
+                if prewarmed:
+                    self.warming = asyncio.create_task(self.admit_joiners())
+                await asyncio.gather(self.checkpoint(), self.flush_statuses(), self.now_playing.flush())
+            else:
+                self.maybe_prewarm()
+                await self.now_playing.flush()
 
 
 async def main():
-    store = await get_store()
-    spotify = Spotify()
+    started = time.monotonic()
+    if config.settings.DIAGNOSTICS_ENABLED:
+        # Only pay for the profiler imports when they're wanted.
+        from utils.diagnostics import Diagnostics
+        Diagnostics.from_config().start()
+    store = new_store()
+    spotify = Spotify(store)
+    await asyncio.gather(store.init(), spotify.connect())
     worker = Worker(store, spotify)
+    config.on_reload(worker.reconfigure)
+    asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, config.reload)
+    logging.info("Worker ready in %dms", (time.monotonic() - started) * 1000)
     await worker.run()
 
 if __name__ == "__main__":
@@ -257,6 +861,8 @@ if __name__ == "__main__":
     args = parser.parse_args()
     if args.config:
         config.load(args.config)
-    logging.basicConfig(level=config.LOG_LEVEL)
+    # Fail now, not mid-sync, if anything is missing or malformed.
+    config.settings
+    logs.setup()
     logging.debug("Debug logs enabled")
     asyncio.run(main())